@@ -0,0 +1,222 @@
+import os
+import threading
+from functools import wraps
+
+from flask import Blueprint, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from audio_model import audio_moderate
+from image_model import image_moderate
+from job_queue import get_job_queue, validate_callback_url
+from metrics import timed, track
+from result_cache import cached, hash_text, lookup, store
+from text_model import predict_text_mod, predict_text_mod_many
+from uploads import read_upload, save_upload, upload_name, upload_tempfile
+from video_model import video_moderate
+
+
+api = Blueprint("api", __name__, url_prefix="/v1")
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the moderation requests a worker runs at once, MAX_CONCURRENT_REQUESTS (default 4)
+    unless a limit is given. Requests over the limit are shed straight away with a 429
+    instead of queueing behind minutes of Whisper/ONNX work.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._semaphore = None
+        self._semaphore_lock = threading.Lock()
+
+    def _get_semaphore(self):
+        # Created on first use so the limit can come from the .env loaded by app.py
+        with self._semaphore_lock:
+            if self._semaphore is None:
+                if self.limit is None:
+                    self.limit = int(os.getenv("MAX_CONCURRENT_REQUESTS", 4))
+                self._semaphore = threading.BoundedSemaphore(self.limit)
+        return self._semaphore
+
+    def __call__(self, view):
+        @wraps(view)
+        def limited_view(*args, **kwargs):
+            if request.method == "GET":
+                return view(*args, **kwargs)
+
+            semaphore = self._get_semaphore()
+            if not semaphore.acquire(blocking=False):
+                response = jsonify({"error": f"Server is busy, {self.limit} requests are already being moderated"})
+                response.status_code = 429
+                response.headers["Retry-After"] = os.getenv("RETRY_AFTER_SECONDS", "5")
+                return response
+            try:
+                return view(*args, **kwargs)
+            finally:
+                semaphore.release()
+
+        return limited_view
+
+
+limit_concurrency = ConcurrencyLimiter()
+
+
+def moderate_text(text):
+    with track("text"):
+        return cached("text", hash_text(text), lambda: _timed_openai(predict_text_mod, text))
+
+
+def moderate_texts(texts):
+    """Moderates many texts, sending every cache miss in one batched upstream call."""
+    with track("text"):
+        hashes = [hash_text(text) for text in texts]
+        results = [lookup("text", text_hash) for text_hash in hashes]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            for i, result in zip(misses, _timed_openai(predict_text_mod_many, [texts[i] for i in misses])):
+                store("text", hashes[i], result)
+                results[i] = result
+        return results
+
+
+def _timed_openai(predict, texts):
+    with timed("openai"):
+        return predict(texts)
+
+
+def moderate_image(file_storage):
+    with track("image"):
+        image_stream, image_hash = read_upload(file_storage)
+        # Only the scores are cached, the same bytes may come back under another upload name
+        scores = cached("image", image_hash, lambda: image_moderate(image_stream, image_name="image").get("image"))
+        return {upload_name(file_storage): scores} if scores is not None else {}
+
+
+def moderate_video(file_storage):
+    with track("video"), upload_tempfile(file_storage) as (video_path, video_hash):
+        return cached("video", video_hash, lambda: video_moderate(video_path))
+
+
+def moderate_audio(file_storage):
+    with track("audio"), upload_tempfile(file_storage) as (audio_path, audio_hash):
+        return cached("audio", audio_hash, lambda: audio_moderate(audio_path))
+
+
+def _error(message, status_code):
+    response = jsonify({"error": message})
+    response.status_code = status_code
+    return response
+
+
+def _uploaded_file(modality):
+    return request.files.get("file") or request.files.get(modality)
+
+
+@api.route("/text", methods=["POST"])
+@limit_concurrency
+def text():
+    """
+    Moderates a "text" string, or a "texts" list of up to TEXT_BATCH_MAX_SIZE (default 256)
+    strings, sent as a JSON object or as form fields.
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = request.form
+    if not isinstance(payload, dict):
+        return _error('Send a JSON object with a "text" string or a "texts" list', 400)
+
+    if "texts" in payload:
+        texts = payload["texts"]
+        if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+            return _error('"texts" must be a non-empty list of strings', 400)
+        max_texts = int(os.getenv("TEXT_BATCH_MAX_SIZE", 256))
+        if len(texts) > max_texts:
+            return _error(f'Send at most {max_texts} "texts" per request', 400)
+        return jsonify({"results": moderate_texts(texts)})
+
+    if not isinstance(payload.get("text"), str) or not payload["text"]:
+        return _error('Send a "text" string or a "texts" list', 400)
+    return jsonify({"result": moderate_text(payload["text"])})
+
+
+@api.route("/image", methods=["POST"])
+@limit_concurrency
+def image():
+    file_storage = _uploaded_file("image")
+    if file_storage is None:
+        return _error('Upload the image as the "file" form field', 400)
+    result = moderate_image(file_storage)
+    if not result:
+        return _error("The upload couldn't be read as an image", 422)
+    return jsonify({"result": result})
+
+
+@api.route("/audio", methods=["POST"])
+@limit_concurrency
+def audio():
+    file_storage = _uploaded_file("audio")
+    if file_storage is None:
+        return _error('Upload the audio as the "file" form field', 400)
+    return jsonify({"result": moderate_audio(file_storage)})
+
+
+@api.route("/video", methods=["POST"])
+@limit_concurrency
+def video():
+    file_storage = _uploaded_file("video")
+    if file_storage is None:
+        return _error('Upload the video as the "file" form field', 400)
+    return jsonify({"result": moderate_video(file_storage)})
+
+
+@api.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Queues an audio or video file for moderation and answers 202 with the job id straight away.
+    Form fields: modality ("audio" or "video"), file, and optionally callback_url,
+    which receives the finished job as a JSON POST (see validate_callback_url).
+    """
+    modality = request.form.get("modality")
+    file_storage = _uploaded_file(modality or "file")
+    if modality not in ("audio", "video") or file_storage is None:
+        return _error('Send modality ("audio" or "video") and the media as the "file" form field', 400)
+
+    callback_url = request.form.get("callback_url") or None
+    if callback_url:
+        try:
+            validate_callback_url(callback_url)
+        except ValueError as ex:
+            return _error(str(ex), 400)
+
+    media_path, media_hash = save_upload(file_storage, os.getenv("JOB_UPLOAD_DIR", "./job_uploads"))
+    job_id = get_job_queue().submit(
+        modality,
+        media_path,
+        content_hash=media_hash,
+        callback_url=callback_url,
+        result=lookup(modality, media_hash),
+    )
+    response = jsonify({"job_id": job_id, "status_url": f"{api.url_prefix}/jobs/{job_id}"})
+    response.status_code = 202
+    return response
+
+
+@api.route("/jobs/stats", methods=["GET"])
+def job_stats():
+    return jsonify(get_job_queue().stats())
+
+
+@api.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return _error(f"No job {job_id}", 404)
+    return jsonify(job)
+
+
+@api.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    if request.path.startswith(api.url_prefix):
+        return _error(f"Uploads are limited to {request.max_content_length} bytes", 413)
+    return error
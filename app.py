@@ -1,17 +1,24 @@
+import logging
 import os
-from time import time
 import openai
 from dotenv import load_dotenv
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request
 
-from audio_model import audio_moderate
-from image_model import image_moderate
-from text_model import predict_text_mod
-from video_model import video_moderate
+from api import api, limit_concurrency, moderate_audio, moderate_image, moderate_text, moderate_video
+import metrics
+from audio_model import load_whisper_models
+from model_registry import preload, warmup
+from result_cache import cache_stats
+from uploads import SpooledRequest
 
 
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 app = Flask(__name__)
+app.request_class = SpooledRequest
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_CONTENT_LENGTH", 200 * 1024 * 1024))
+app.register_blueprint(api)
+metrics.init_app(app)
 HOST = os.getenv("HOST")
 PORT = os.getenv("PORT")
 
@@ -21,33 +28,28 @@ openai.api_key = OPENAI_API_KEY
 
 
 @app.route("/", methods=["GET", "POST"])
+@limit_concurrency
 def text_mod():
     if request.method == "POST":
         # try:
         if "text" in request.form:
             input_text = request.form["text"]
-            response = predict_text_mod(input_text)
+            response = moderate_text(input_text)
             return render_template("index.html", response=response, type="text")
 
         elif "image" in request.files:
             input_image = request.files["image"]
-            image_path = save_image(input_image)
-            response = image_moderate(image_path)
+            response = moderate_image(input_image)
             return render_template("index.html", response=response, type="image")
 
         elif "video" in request.files:
             input_video = request.files["video"]
-            video_path = save_video(input_video)
-            st = time()
-            response = video_moderate(video_path)
-            et = time()
-            print("TIMEEEEEEEEEEEEEEEE", et - st)
+            response = moderate_video(input_video)
             return render_template("index.html", response=response, type="video")
 
         elif "audio" in request.files:
             input_audio = request.files["audio"]
-            audio_path = save_audio(input_audio)
-            response = audio_moderate(audio_path)
+            response = moderate_audio(input_audio)
             return render_template("index.html", response=response, type="audio")
 
     # except:
@@ -57,29 +59,23 @@ def text_mod():
     return render_template("index.html")
 
 
-def save_image(image):
-    if not os.path.exists("./Images"):
-        os.makedirs("./Images")
-    image_path = os.path.join("./Images", image.filename)
-    image.save(image_path)
-    return image_path
+@app.route("/cache/stats", methods=["GET"])
+def result_cache_stats():
+    return jsonify(cache_stats())
 
 
-def save_video(video):
-    if not os.path.exists("./Videos"):
-        os.makedirs("./Videos")
-    video_path = os.path.join("./Videos", video.filename)
-    video.save(video_path)
-    return video_path
-
-
-def save_audio(audio):
-    if not os.path.exists("./Audios"):
-        os.makedirs("./Audios")
-    audio_path = os.path.join("./Audios", audio.filename)
-    audio.save(audio_path)
-    return audio_path
+def preload_models():
+    """
+    Loads what can safely be shared with forked workers: the ONNX model bytes. Whisper's torch
+    pool isn't fork-safe, each worker loads its own (gunicorn.conf.py post_fork).
+    """
+    preload()
 
 
 if __name__ == "__main__":
+    from job_queue import requeue_stale_jobs
+
+    requeue_stale_jobs()
+    warmup()
+    load_whisper_models()
     app.run(host=HOST, port=PORT)
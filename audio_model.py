@@ -1,49 +1,341 @@
-import librosa
+import contextvars
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import numpy as np
 import openai
 import whisper
 from googletrans import Translator
 from moviepy.editor import AudioFileClip
+from media_demux import iter_audio_windows
+from metrics import observe_stage, timed
+from result_cache import MemoryCache, hash_text
 from text_model import predict_text_mod
+from vad import speech_only
+
+
+WHISPER_SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+MAX_DURATION = 45
 
 
 def duration_check(audio_file):
-    audio = AudioFileClip(audio_file)
-    audio_duration = audio.duration
-    if audio_duration > 45:
+    if isinstance(audio_file, np.ndarray):
+        audio_duration = len(audio_file) / WHISPER_SAMPLE_RATE
+    else:
+        audio = AudioFileClip(audio_file)
+        audio_duration = audio.duration
+    if audio_duration > MAX_DURATION:
         return False
     else:
         return True
 
 
-def transcribe_audio(audio_file):
+_whisper_pools = {}
+_whisper_pools_lock = threading.Lock()
+
+
+def load_whisper_models(model_name=None):
+    """
+    Returns the process-wide pool of Whisper models, loading it on first use.
+    model_name defaults to the WHISPER_MODEL environment variable ("base") and the pool
+    holds WHISPER_POOL_SIZE (default 1) copies of the model.
+    """
+    model_name = model_name or os.getenv("WHISPER_MODEL", "base")
+    if model_name not in whisper.available_models():
+        raise ValueError(
+            "Invalid Whisper model {} specified. Supported "
+            "models are {}".format(model_name, ", ".join(whisper.available_models()))
+        )
+
+    pool = _whisper_pools.get(model_name)
+    if pool is not None:
+        return pool
+
+    with _whisper_pools_lock:
+        pool = _whisper_pools.get(model_name)
+        if pool is None:
+            pool = queue.Queue()
+            for _ in range(int(os.getenv("WHISPER_POOL_SIZE", 1))):
+                pool.put(whisper.load_model(model_name))
+            _whisper_pools[model_name] = pool
+
+    return pool
+
+
+@contextmanager
+def whisper_model(model_name=None):
+    """
+    Checks a Whisper model out of the pool for the duration of the block.
+    transcribe() installs kv-cache hooks on the model's modules, so a model
+    must never run two transcriptions at once.
+    """
+    pool = load_whisper_models(model_name)
+    model = pool.get()
+    try:
+        yield model
+    finally:
+        pool.put(model)
+
+
+def decode_audio(audio_file):
+    """
+    Decodes and resamples straight to 16 kHz mono float32 in a single ffmpeg pass.
+    Samples that were already decoded in memory (e.g. by media_demux) are passed through.
+    """
+    if isinstance(audio_file, np.ndarray):
+        return np.array(audio_file, dtype=np.float32)
+    return whisper.load_audio(audio_file, sr=WHISPER_SAMPLE_RATE)
+
+
+def normalize_audio(audio):
+    peak = np.max(np.abs(audio)) if audio.size else 0
+    if peak > 0:
+        audio /= peak
+    return audio
+
+
+def detect_language(model, audio):
+    """Whisper's language detection on the first 30 seconds, one encoder pass instead of a transcription."""
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels).to(model.device)
+    _, probs = model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+
+def transcribe_audio(audio_file, model_name=None, translate=False):
+    """
+    Whisper transcription of audio_file. With translate, the language is detected first and
+    speech that isn't English is translated to English in the same pass (task="translate"),
+    instead of transcribing and then translating the audio a second time. The result's "task"
+    says which one ran.
+    """
     print("Transcribing the Audio")
-    audio, sr = librosa.load(audio_file)
-    audio /= np.max(np.abs(audio))
-    model = whisper.load_model("base")
-    result = model.transcribe(audio)
+    timings = {}
+
+    st = time.perf_counter()
+    audio = decode_audio(audio_file)
+    timings["decode"] = time.perf_counter() - st
+
+    st = time.perf_counter()
+    audio = normalize_audio(audio)
+    timings["normalize"] = time.perf_counter() - st
+
+    st = time.perf_counter()
+    with whisper_model(model_name) as model:
+        language = detect_language(model, audio) if translate else None
+        task = "translate" if language not in (None, "en") else "transcribe"
+        result = model.transcribe(audio, task=task, language=language, fp16=model.device.type == "cuda")
+    timings["transcribe"] = time.perf_counter() - st
+    result["task"] = task
+
+    result["timings"] = timings
+    # Samples passed in were decoded, and timed, by the caller
+    if not isinstance(audio_file, np.ndarray):
+        observe_stage("decode", timings["decode"])
+    observe_stage("normalize", timings["normalize"])
+    observe_stage("whisper", timings["transcribe"])
     return result
 
 
+_translators = threading.local()
+
+_translation_cache = None
+_translation_cache_lock = threading.Lock()
+
+
 def translate_text(text, target_language):
+    """Translates with googletrans, reusing one Translator per thread."""
     print("Translating the Text")
-    translator = Translator()
+    translator = getattr(_translators, "translator", None)
+    if translator is None:
+        translator = _translators.translator = Translator()
     translation = translator.translate(text, dest=target_language)
     return translation.text
 
 
+def _whisper_translate(text, language, audio):
+    # moderate_transcript translates in its transcription pass, this is for transcripts made without
+    if audio is None:
+        raise ValueError("The whisper translation backend needs the audio")
+    with whisper_model() as model:
+        result = model.transcribe(audio, task="translate", language=language, fp16=model.device.type == "cuda")
+    return result["text"]
+
+
+def _googletrans_translate(text, language, audio):
+    return translate_text(text, "en")
+
+
+def _no_translation(text, language, audio):
+    return text
+
+
+# backend name -> callable(text, source language, 16 kHz audio or None) returning English text
+TRANSLATION_BACKENDS = {
+    "whisper": _whisper_translate,
+    "googletrans": _googletrans_translate,
+    "none": _no_translation,
+}
+
+
+def register_translation_backend(name, translate):
+    """Plugs in another translation backend, e.g. a local MarianMT/Argos model, selectable by name."""
+    TRANSLATION_BACKENDS[name] = translate
+
+
+def get_translation_cache():
+    global _translation_cache
+    if _translation_cache is None:
+        with _translation_cache_lock:
+            if _translation_cache is None:
+                _translation_cache = MemoryCache(max_entries=int(os.getenv("TRANSLATION_CACHE_MAX_ENTRIES", 10000)))
+    return _translation_cache
+
+
+def translate_transcript(transcribed_result, audio=None):
+    """
+    English text of a Whisper transcription, for the moderation endpoint.
+    Uses the language Whisper detected: English transcripts are returned as they are, others go
+    through TRANSLATION_BACKEND, "whisper" (default: Whisper's own task="translate" on the audio,
+    no network hop), "googletrans", "none" or one added with register_translation_backend.
+    Translations are cached in memory by backend, language and text, or by the audio for the
+    whisper backend, which translates the audio rather than the text.
+    """
+    text = transcribed_result["text"]
+    language = transcribed_result.get("language")
+    if language == "en" or transcribed_result.get("task") == "translate":
+        return text
+
+    backend = os.getenv("TRANSLATION_BACKEND", "whisper")
+    if backend not in TRANSLATION_BACKENDS:
+        raise ValueError(
+            "Invalid translation backend {} specified. Supported "
+            "backends are {}".format(backend, ", ".join(TRANSLATION_BACKENDS.keys()))
+        )
+
+    cache = get_translation_cache()
+    if backend == "whisper" and audio is not None:
+        key = f"{backend}:{language}:{hashlib.sha256(np.ascontiguousarray(audio).tobytes()).hexdigest()}"
+    else:
+        key = f"{backend}:{language}:{hash_text(text)}"
+    translation = cache.get(key)
+    if translation is None:
+        translation = TRANSLATION_BACKENDS[backend](text, language, audio)
+        cache.set(key, translation)
+    return translation
+
+
+def moderate_transcript(audio):
+    """
+    Transcribes, translates and moderates audio. A NumPy VAD pass (VAD_MODE, see vad.speech_only)
+    runs first: audio without speech never reaches Whisper, and silence and non-speech
+    stretches are trimmed from the rest.
+    """
+    with timed("decode"):
+        audio = decode_audio(audio)
+    with timed("vad"):
+        audio = speech_only(audio, WHISPER_SAMPLE_RATE)
+    if audio is None:
+        logging.info("No speech detected, skipping transcription")
+        return "No text found in the audio"
+    # The whisper backend translates in the transcription pass itself, one Whisper run per clip
+    transcribed_result = transcribe_audio(audio, translate=os.getenv("TRANSLATION_BACKEND", "whisper") == "whisper")
+    logging.debug(transcribed_result)
+    if not transcribed_result["text"]:
+        return "No text found in the audio"
+    with timed("translate"):
+        translated_text = translate_transcript(transcribed_result, audio)
+    with timed("openai"):
+        MODERATION_CLASS = predict_text_mod(translated_text)
+    return MODERATION_CLASS
+
+
+def merge_window_results(window_results):
+    """
+    Folds per-window moderation classes into one: a category is flagged if any window
+    flags it and its score is the highest any window gave it. Windows without speech
+    only appear in the timeline.
+    """
+    moderation_classes = [result for result in window_results if isinstance(result, dict)]
+    if not moderation_classes:
+        return None
+
+    category_scores = {}
+    categories = {}
+    for moderation_class in moderation_classes:
+        for key, value in moderation_class["category_scores"].items():
+            category_scores[key] = max(category_scores.get(key, 0.0), float(value))
+        for key, value in moderation_class["categories"].items():
+            categories[key] = categories.get(key, False) or bool(value)
+
+    return {
+        "flagged": any(moderation_class["flagged"] for moderation_class in moderation_classes),
+        "categories": categories,
+        "category_scores": {key: f"{value:.15f}" for key, value in category_scores.items()},
+    }
+
+
+def audio_moderate_windowed(audio_file, window_seconds=None, overlap_seconds=None):
+    """
+    Moderates audio of any length in overlapping windows (LONG_MEDIA_WINDOW_SECONDS, default 30,
+    overlapping by LONG_MEDIA_OVERLAP_SECONDS, default 5). Windows are streamed from ffmpeg and
+    transcribed/moderated on LONG_MEDIA_WORKERS threads (default 2), with at most that many
+    windows in flight, so memory stays flat however long the file is. Set WHISPER_POOL_SIZE
+    to the same number for the transcriptions themselves to overlap.
+
+    outputs:
+        the merged moderation class plus a "timeline" of per-window results,
+        "No text found in the audio" if no window had speech, or "No audio"
+    """
+    window_seconds = window_seconds or float(os.getenv("LONG_MEDIA_WINDOW_SECONDS", 30))
+    overlap_seconds = overlap_seconds or float(os.getenv("LONG_MEDIA_OVERLAP_SECONDS", 5))
+    n_workers = int(os.getenv("LONG_MEDIA_WORKERS", 2))
+
+    timeline = []
+    pending = deque()
+
+    def _collect(start, duration, future):
+        timeline.append({"start": start, "end": start + duration, "audio": future.result()})
+
+    with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="audio-window") as executor:
+        for start, samples in iter_audio_windows(audio_file, window_seconds, overlap_seconds, WHISPER_SAMPLE_RATE):
+            duration = len(samples) / WHISPER_SAMPLE_RATE
+            pending.append((start, duration, executor.submit(contextvars.copy_context().run, moderate_transcript, samples)))
+            while len(pending) > n_workers:
+                _collect(*pending.popleft())
+        while pending:
+            _collect(*pending.popleft())
+
+    if not timeline:
+        return "No audio"
+
+    merged = merge_window_results([window["audio"] for window in timeline])
+    if merged is None:
+        return "No text found in the audio"
+
+    merged["timeline"] = timeline
+    return merged
+
+
 def audio_moderate(audio_file):
+    """
+    inputs:
+        audio_file: path of an audio file, or 16 kHz mono float32 samples
+    Files longer than MAX_DURATION are moderated in windows unless LONG_MEDIA_MODE is "reject".
+    """
     length = duration_check(audio_file)
     if length == False:
+        if os.getenv("LONG_MEDIA_MODE", "windowed") == "windowed" and not isinstance(audio_file, np.ndarray):
+            return audio_moderate_windowed(audio_file)
         return "Please upload audio file having length of duration less than 45 seconds"
     else:
-        transcribed_result = transcribe_audio(audio_file)
-        print(transcribed_result)
-        if not transcribed_result["text"]:
-            return "No text found in the audio"
-        translated_text = translate_text(transcribed_result["text"], "en")
-        MODERATION_CLASS = predict_text_mod(translated_text)
-        return MODERATION_CLASS
+        return moderate_transcript(audio_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _Request:
+    def __init__(self, items):
+        self.items = items
+        self.results = [None] * len(items)
+        self.remaining = len(items)
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent callers into shared batches.
+
+    A background thread takes the first waiting chunk, then keeps pulling chunks
+    until max_batch_size items are gathered or max_wait seconds have passed,
+    calls process_batch once on the combined items and scatters the outputs
+    back to each caller's future in submission order. If process_batch raises, or
+    doesn't return one output per item, every caller in that batch gets the exception.
+
+    batcher = MicroBatcher(lambda items: [len(i) for i in items], max_batch_size=8)
+    batcher.submit(["a", "bb"]).result()  # [1, 2]
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.005, name="micro-batcher"):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._carry = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, items):
+        """Queues items and returns a Future resolving to the list of their outputs."""
+        items = list(items)
+        request = _Request(items)
+        if not items:
+            request.future.set_result([])
+            return request.future
+
+        self._ensure_thread()
+        # Large submissions are split so no batch ever exceeds max_batch_size
+        for start in range(0, len(items), self.max_batch_size):
+            self._queue.put((request, start, min(start + self.max_batch_size, len(items))))
+        return request.future
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            first = self._queue.get()
+
+        chunks = [first]
+        size = first[2] - first[1]
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                chunk = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            chunk_size = chunk[2] - chunk[1]
+            if size + chunk_size > self.max_batch_size:
+                self._carry = chunk
+                break
+            chunks.append(chunk)
+            size += chunk_size
+
+        return chunks
+
+    def _run(self):
+        while True:
+            chunks = self._next_batch()
+            items = []
+            for request, start, end in chunks:
+                items.extend(request.items[start:end])
+
+            try:
+                outputs = self.process_batch(items)
+                if len(outputs) != len(items):
+                    raise ValueError(f"{self.name} got {len(outputs)} outputs for a batch of {len(items)}")
+            except Exception as ex:
+                logging.exception(f"{self.name} failed on a batch of {len(items)}", exc_info=True)
+                for request, _, _ in chunks:
+                    if not request.future.done():
+                        request.future.set_exception(ex)
+                continue
+
+            offset = 0
+            for request, start, end in chunks:
+                request.results[start:end] = outputs[offset : offset + end - start]
+                offset += end - start
+                request.remaining -= end - start
+                if request.remaining == 0 and not request.future.done():
+                    request.future.set_result(request.results)
@@ -0,0 +1,596 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import wave
+import zlib
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# Settings that change what is being measured, recorded with every run
+CONFIG_ENV_PREFIXES = (
+    "NSFW_",
+    "ORT_",
+    "WHISPER_",
+    "VAD_",
+    "FRAME_",
+    "SKIP_N_FRAMES",
+    "IMAGE_RESIZE_MODE",
+    "TRANSLATION_",
+    "TEXT_MODERATION_",
+    "VISUAL_",
+    "LONG_MEDIA_",
+    "VIDEO_BRANCH_MODE",
+)
+
+AUDIO_SAMPLE_RATE = 16000
+VIDEO_FPS = 25
+
+# The synthetic media of each suite:
+#     images: (kind, (width, height), count), every group is moderated as one batch
+#     videos: (scene, (width, height), seconds)
+#     audio: (kind, seconds)
+SUITES = {
+    "quick": {
+        "images": [("random", (640, 480), 8), ("solid", (640, 480), 8)],
+        "videos": [("static", (320, 240), 5), ("moving", (320, 240), 5)],
+        "audio": [("tone", 5), ("silent", 5)],
+    },
+    "full": {
+        "images": [
+            ("random", (256, 256), 16),
+            ("solid", (256, 256), 16),
+            ("random", (1024, 768), 16),
+            ("solid", (1024, 768), 16),
+            ("random", (1920, 1080), 16),
+        ],
+        "videos": [
+            ("static", (320, 240), 10),
+            ("moving", (320, 240), 10),
+            ("static", (640, 360), 10),
+            ("moving", (640, 360), 10),
+            ("moving", (1280, 720), 10),
+            ("static", (640, 360), 60),
+            ("moving", (640, 360), 60),
+        ],
+        "audio": [("tone", 10), ("speech", 10), ("music-beat", 10), ("silent", 10), ("tone", 40), ("silent", 40)],
+    },
+}
+
+
+def _rng(name):
+    # Seeded by the file name, so every file is the same whatever else gets generated
+    return np.random.default_rng(zlib.crc32(name.encode()))
+
+
+def make_image(path, kind, size):
+    """Writes a JPEG of random noise or a single random color."""
+    width, height = size
+    rng = _rng(os.path.basename(path))
+    if kind == "random":
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    elif kind == "solid":
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        pixels[:] = rng.integers(0, 256, 3, dtype=np.uint8)
+    else:
+        raise ValueError(f"Invalid image kind {kind} specified. Supported kinds are random, solid")
+    Image.fromarray(pixels).save(path, quality=90)
+
+
+def make_video(path, scene, size, seconds, fps=VIDEO_FPS):
+    """
+    Writes an MP4 without audio:
+        static: the same noisy gradient in every frame, so frame dedup keeps almost nothing
+        moving: a square crossing a panning gradient, so most sampled frames differ
+    """
+    if scene not in ("static", "moving"):
+        raise ValueError(f"Invalid video scene {scene} specified. Supported scenes are static, moving")
+    width, height = size
+    rng = _rng(os.path.basename(path))
+    gradient = np.linspace(0, 255, 2 * width, dtype=np.float32)
+    noise = rng.normal(0, 8, (height, width, 1)).astype(np.float32)
+    color = rng.integers(64, 256, 3).tolist()
+    square = max(min(width, height) // 6, 4)
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise ValueError(f"OpenCV can't write {path}")
+    try:
+        n_frames = int(seconds * fps)
+        for frame_i in range(n_frames):
+            progress = frame_i / max(n_frames - 1, 1) if scene == "moving" else 0.0
+            offset = int(progress * width)
+            row = gradient[offset : offset + width]
+            frame = np.clip(np.broadcast_to(row[None, :, None], (height, width, 3)) + noise, 0, 255).astype(np.uint8)
+            if scene == "moving":
+                x = int(progress * (width - square))
+                y = (height - square) // 2
+                cv2.rectangle(frame, (x, y), (x + square, y + square), color, -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+
+
+def _harmonics(f0, seconds, n_harmonics, tilt, sample_rate):
+    """A harmonic tone, harmonic h at 1 / h**tilt, f0 being a frequency or one per sample (gliding pitch)."""
+    n = int(seconds * sample_rate)
+    phase = 2 * np.pi * np.cumsum(np.broadcast_to(f0, (n,))) / sample_rate
+    return sum(np.sin(harmonic * phase) / harmonic**tilt for harmonic in range(1, n_harmonics + 1))
+
+
+def _decay(n, attack, decay, sample_rate):
+    t = np.arange(n) / sample_rate
+    return np.minimum(t / attack, 1) * np.exp(-t / decay)
+
+
+# C, Am, F, G, one chord every two seconds
+CHORDS = ((261.6, 329.6, 392.0), (220.0, 261.6, 329.6), (174.6, 220.0, 261.6), (196.0, 246.9, 293.7))
+
+
+def synth_speech(seconds, rng, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Speech-like audio: a voice with a gliding 120-220 Hz pitch, cut into 120-280 ms syllables
+    by short gaps and the odd pause, with noise bursts for consonants.
+    """
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+    f0 = 160 + 40 * np.sin(2 * np.pi * 0.7 * t + rng.uniform(0, 2 * np.pi)) + 20 * np.sin(2 * np.pi * 3.1 * t)
+    envelope = np.zeros(n)
+    start = 0
+    while start < n:
+        syllable = int(rng.uniform(0.12, 0.28) * sample_rate)
+        gap = int(rng.uniform(0.3, 0.6) * sample_rate if rng.random() < 0.1 else rng.uniform(0.04, 0.15) * sample_rate)
+        shape = np.hanning(syllable)[: n - start]
+        envelope[start : start + len(shape)] = shape * rng.uniform(0.5, 1)
+        start += syllable + gap
+    consonants = rng.standard_normal(n) * 0.15 * (np.roll(envelope, int(0.03 * sample_rate)) > 0.05) * (envelope < 0.3)
+    samples = 0.2 * _harmonics(f0, seconds, 30, 1.0, sample_rate) * envelope + np.convolve(consonants, np.ones(4) / 4, "same")
+    return 0.5 * samples / np.max(np.abs(samples))
+
+
+def synth_music(style, seconds, rng, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    An instrumental music bed, in one of MUSIC_STYLES:
+        pad: sustained chords, cross-faded
+        arpeggio: plucked notes, four a second, over the pad
+        piano: struck chords, two a second, ringing out
+        beat: the pad with a kick every beat and a snare every other one, at 120 bpm
+    """
+    n = int(seconds * sample_rate)
+    samples = np.zeros(n)
+    if style in ("pad", "arpeggio", "beat"):
+        step = 2 * sample_rate
+        for i, start in enumerate(range(0, n, step)):
+            length = min(step, n - start)
+            t = np.arange(length) / sample_rate
+            fade = np.clip(np.minimum(t, t[-1] - t) / 0.2, 1e-3, 1)
+            samples[start : start + length] += sum(_harmonics(f, length / sample_rate, 8, 1.5, sample_rate) for f in CHORDS[i % 4]) * fade
+        samples /= np.max(np.abs(samples))
+    if style == "arpeggio":
+        step = sample_rate // 4
+        for i, start in enumerate(range(0, n, step)):
+            length = min(2 * step, n - start)
+            note = 2 * CHORDS[(i // 8) % 4][i % 3]
+            samples[start : start + length] += _harmonics(note, length / sample_rate, 6, 1.2, sample_rate) * _decay(length, 0.005, 0.25, sample_rate)
+    elif style == "piano":
+        step = sample_rate // 2
+        for i, start in enumerate(range(0, n, step)):
+            length = min(3 * step, n - start)
+            chord = sum(_harmonics(f, length / sample_rate, 8, 1.3, sample_rate) for f in CHORDS[(i // 4) % 4])
+            samples[start : start + length] += chord * _decay(length, 0.01, 0.6, sample_rate)
+    elif style == "beat":
+        samples *= 0.5
+        step = sample_rate // 2
+        for i, start in enumerate(range(0, n, step)):
+            length = min(step, n - start)
+            t = np.arange(length) / sample_rate
+            samples[start : start + length] += 0.8 * np.sin(2 * np.pi * 55 * t) * _decay(length, 0.005, 0.15, sample_rate)
+            if i % 2:
+                samples[start : start + length] += 0.4 * rng.standard_normal(length) * _decay(length, 0.002, 0.08, sample_rate)
+    elif style != "pad":
+        raise ValueError(f"Invalid music style {style} specified. Supported styles are {', '.join(MUSIC_STYLES)}")
+    return 0.5 * samples / np.max(np.abs(samples))
+
+
+MUSIC_STYLES = ("pad", "arpeggio", "piano", "beat")
+
+
+def make_audio(path, kind, seconds, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Writes a 16-bit mono WAV: a tone with harmonics, amplitude modulated at a syllable rate
+    so the VAD treats it as speech, speech-like audio (see synth_speech), an instrumental
+    music bed (music-<style>, see synth_music), or digital silence.
+    """
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    if kind == "tone":
+        voice = sum(np.sin(2 * np.pi * 220 * harmonic * t) / harmonic for harmonic in (1, 2, 3, 4))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+        samples = 0.3 * voice * envelope / 2
+    elif kind == "speech":
+        samples = synth_speech(seconds, _rng(os.path.basename(path)), sample_rate)
+    elif kind.startswith("music-"):
+        samples = synth_music(kind[len("music-") :], seconds, _rng(os.path.basename(path)), sample_rate)
+    elif kind == "silent":
+        samples = np.zeros_like(t)
+    else:
+        raise ValueError(f"Invalid audio kind {kind} specified. Supported kinds are tone, speech, music-<style>, silent")
+
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def generate_media(media_dir, suite="quick"):
+    """
+    Writes the synthetic media of a suite to media_dir, skipping files that are already there.
+    outputs:
+        {"images": [{"name", "paths"}], "videos": [{"name", "path", "frames"}], "audio": [{"name", "path", "seconds"}]}
+    """
+    if suite not in SUITES:
+        raise ValueError("Invalid benchmark suite {} specified. Supported suites are {}".format(suite, ", ".join(SUITES)))
+    os.makedirs(media_dir, exist_ok=True)
+    spec = SUITES[suite]
+    media = {"images": [], "videos": [], "audio": []}
+
+    for kind, size, count in spec["images"]:
+        name = f"{kind}-{size[0]}x{size[1]}"
+        paths = [os.path.join(media_dir, f"{name}-{i}.jpg") for i in range(count)]
+        for path in paths:
+            if not os.path.exists(path):
+                make_image(path, kind, size)
+        media["images"].append({"name": f"{name}x{count}", "paths": paths})
+
+    for scene, size, seconds in spec["videos"]:
+        name = f"{scene}-{size[0]}x{size[1]}-{seconds}s"
+        path = os.path.join(media_dir, f"{name}.mp4")
+        if not os.path.exists(path):
+            make_video(path, scene, size, seconds)
+        media["videos"].append({"name": name, "path": path, "frames": int(seconds * VIDEO_FPS)})
+
+    for kind, seconds in spec["audio"]:
+        name = f"{kind}-{seconds}s"
+        path = os.path.join(media_dir, f"{name}.wav")
+        if not os.path.exists(path):
+            make_audio(path, kind, seconds)
+        media["audio"].append({"name": name, "path": path, "seconds": seconds})
+
+    return media
+
+
+# Every category the moderation endpoint returns, video_model._video_score reads them all
+MODERATION_CATEGORIES = (
+    "sexual",
+    "hate",
+    "harassment",
+    "self-harm",
+    "sexual/minors",
+    "hate/threatening",
+    "violence/graphic",
+    "self-harm/intent",
+    "self-harm/instructions",
+    "harassment/threatening",
+    "violence",
+)
+
+
+def _fake_moderation(input, model=None, **kwargs):
+    inputs = input if isinstance(input, list) else [input]
+    categories = MODERATION_CATEGORIES
+    return {
+        "id": "modr-benchmark",
+        "model": model or "text-moderation-latest",
+        "results": [
+            {
+                "flagged": False,
+                "categories": {category: False for category in categories},
+                "category_scores": {category: 0.0 for category in categories},
+            }
+            for _ in inputs
+        ]
+    }
+
+
+def _fake_translate(text, language, audio):
+    return text
+
+
+@contextmanager
+def stubbed_external_calls():
+    """
+    Swaps the OpenAI moderation endpoint and transcript translation for local stubs that
+    return immediately, so runs measure this service and not the network.
+    """
+    import text_model
+    from audio_model import TRANSLATION_BACKENDS, register_translation_backend
+
+    original_create = text_model.create_moderation
+    original_backend = os.environ.get("TRANSLATION_BACKEND")
+    text_model.create_moderation = _fake_moderation
+    register_translation_backend("benchmark", _fake_translate)
+    os.environ["TRANSLATION_BACKEND"] = "benchmark"
+    try:
+        yield
+    finally:
+        text_model.create_moderation = original_create
+        TRANSLATION_BACKENDS.pop("benchmark", None)
+        if original_backend is None:
+            os.environ.pop("TRANSLATION_BACKEND", None)
+        else:
+            os.environ["TRANSLATION_BACKEND"] = original_backend
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def process_peak_rss():
+    """Peak resident set size of this process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSS:
+    """Samples the RSS on a background thread for the duration of the block and keeps the peak."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while True:
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="benchmark-rss", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# Benchmark targets: media kind, callable(media item) returning the work done, unit of that work.
+# Imports are deferred so a run of image targets doesn't need Whisper and vice versa.
+
+
+def _image_moderate(item):
+    from image_model import image_moderate
+
+    image_moderate(item["paths"])
+    return len(item["paths"])
+
+
+def _load_images(item):
+    from preprocessing import load_images
+
+    images, _ = load_images(item["paths"], (256, 256), image_names=item["paths"])
+    return len(images)
+
+
+def _check_visual_moderation(item):
+    from visual_moderation import check_visual_moderation
+
+    check_visual_moderation(item["path"])
+    return item["frames"]
+
+
+def _get_interest_frames_from_video(item):
+    from visual_moderation import get_interest_frames_from_video
+
+    get_interest_frames_from_video(item["path"])
+    return item["frames"]
+
+
+def _transcribe_audio(item):
+    from audio_model import transcribe_audio
+
+    transcribe_audio(item["path"])
+    return item["seconds"]
+
+
+def _audio_moderate(item):
+    from audio_model import audio_moderate
+
+    audio_moderate(item["path"])
+    return item["seconds"]
+
+
+TARGETS = {
+    "image_moderate": ("images", _image_moderate, "images"),
+    "load_images": ("images", _load_images, "images"),
+    "check_visual_moderation": ("videos", _check_visual_moderation, "video frames"),
+    "get_interest_frames_from_video": ("videos", _get_interest_frames_from_video, "video frames"),
+    "transcribe_audio": ("audio", _transcribe_audio, "audio seconds"),
+    "audio_moderate": ("audio", _audio_moderate, "audio seconds"),
+}
+DEFAULT_TARGETS = ("image_moderate", "load_images", "check_visual_moderation", "get_interest_frames_from_video", "transcribe_audio")
+
+
+def run_case(target, item, repeats=5, warmup=1):
+    """
+    Times one target on one media item. The warmup calls are timed separately as they
+    include lazy model loading; the repeats give the latency percentiles and throughput.
+    """
+    _, bench, unit = TARGETS[target]
+    report = {"target": target, "media": item["name"], "unit": unit}
+
+    try:
+        with PeakRSS() as rss:
+            warmup_seconds = []
+            for _ in range(warmup):
+                start = time.perf_counter()
+                bench(item)
+                warmup_seconds.append(time.perf_counter() - start)
+
+            latencies = []
+            work = 0
+            for _ in range(repeats):
+                start = time.perf_counter()
+                work += bench(item)
+                latencies.append(time.perf_counter() - start)
+    except Exception as ex:
+        logging.exception(ex, exc_info=True)
+        report["error"] = f"{type(ex).__name__}: {ex}"
+        return report
+
+    latencies = np.asarray(latencies)
+    report.update(
+        repeats=repeats,
+        warmup_seconds=warmup_seconds,
+        mean_seconds=float(latencies.mean()),
+        min_seconds=float(latencies.min()),
+        p50_seconds=float(np.percentile(latencies, 50)),
+        p95_seconds=float(np.percentile(latencies, 95)),
+        p99_seconds=float(np.percentile(latencies, 99)),
+        throughput=work / float(latencies.sum()),
+        peak_rss_bytes=rss.peak,
+        process_peak_rss_bytes=process_peak_rss(),
+    )
+    return report
+
+
+def _git_revision():
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+
+def environment():
+    import onnxruntime
+
+    return {
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "onnxruntime": onnxruntime.__version__,
+        "config": {key: value for key, value in sorted(os.environ.items()) if key.startswith(CONFIG_ENV_PREFIXES)},
+    }
+
+
+def run_benchmarks(media_dir, suite="quick", targets=DEFAULT_TARGETS, repeats=5, warmup=1):
+    """
+    Runs every target on every media item of its kind in the suite, with the OpenAI and
+    translation calls stubbed out.
+    outputs:
+        {"suite", "started_at", "environment", "results": [one run_case report per case]}
+    """
+    for target in targets:
+        if target not in TARGETS:
+            raise ValueError("Invalid benchmark target {} specified. Supported targets are {}".format(target, ", ".join(TARGETS)))
+
+    media = generate_media(media_dir, suite)
+    run = {"suite": suite, "started_at": time.time(), "environment": environment(), "results": []}
+    with stubbed_external_calls():
+        for target in targets:
+            kind = TARGETS[target][0]
+            for item in media[kind]:
+                report = run_case(target, item, repeats=repeats, warmup=warmup)
+                logging.info(json.dumps(report))
+                run["results"].append(report)
+    return run
+
+
+def compare_runs(baseline, candidate):
+    """
+    Lines up two runs case by case.
+    outputs:
+        list of {"target", "media", "p50_ratio", "p95_ratio", "throughput_ratio", "peak_rss_ratio"},
+        ratios being candidate / baseline, so a p50_ratio below 1 is a speedup
+    """
+    baseline_cases = {(case["target"], case["media"]): case for case in baseline["results"] if "error" not in case}
+    comparisons = []
+    for case in candidate["results"]:
+        base = baseline_cases.get((case["target"], case["media"]))
+        if base is None or "error" in case:
+            continue
+        comparison = {"target": case["target"], "media": case["media"]}
+        for key, field in (("p50_ratio", "p50_seconds"), ("p95_ratio", "p95_seconds"), ("throughput_ratio", "throughput"), ("peak_rss_ratio", "peak_rss_bytes")):
+            if base.get(field) and case.get(field) is not None:
+                comparison[key] = case[field] / base[field]
+        comparisons.append(comparison)
+    return comparisons
+
+
+def _print_run(run):
+    print(f"{'target':32} {'media':28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'throughput':>22} {'peak MB':>8}")
+    for case in run["results"]:
+        if "error" in case:
+            print(f"{case['target']:32} {case['media']:28} error: {case['error']}")
+            continue
+        peak = f"{case['peak_rss_bytes'] / 2**20:8.0f}" if case["peak_rss_bytes"] else f"{'-':>8}"
+        throughput = f"{case['throughput']:.1f} {case['unit']}/s"
+        print(
+            f"{case['target']:32} {case['media']:28} {1000 * case['p50_seconds']:9.1f} "
+            f"{1000 * case['p95_seconds']:9.1f} {1000 * case['p99_seconds']:9.1f} {throughput:>22} {peak}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the moderation paths on synthetic media")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate the media if needed and benchmark every target")
+    run.add_argument("--suite", choices=SUITES, default="quick")
+    run.add_argument("--media-dir", default="./benchmark_media", help="where the synthetic media is generated and reused")
+    run.add_argument("--target", dest="targets", action="append", choices=TARGETS, help=f"repeatable (default: {', '.join(DEFAULT_TARGETS)})")
+    run.add_argument("--repeats", type=int, default=5)
+    run.add_argument("--warmup", type=int, default=1)
+    run.add_argument("--output", help="write the results to this JSON file")
+
+    generate = commands.add_parser("generate", help="only generate the synthetic media")
+    generate.add_argument("--suite", choices=SUITES, default="quick")
+    generate.add_argument("--media-dir", default="./benchmark_media")
+
+    compare = commands.add_parser("compare", help="ratios of a run against a baseline run")
+    compare.add_argument("baseline", help="results JSON of the baseline, e.g. the previous commit")
+    compare.add_argument("candidate", help="results JSON to compare against it")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+
+    if args.command == "run":
+        results = run_benchmarks(args.media_dir, args.suite, args.targets or DEFAULT_TARGETS, repeats=args.repeats, warmup=args.warmup)
+        _print_run(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    elif args.command == "generate":
+        print(json.dumps(generate_media(args.media_dir, args.suite), indent=2))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        print(json.dumps(compare_runs(baseline, candidate), indent=2))
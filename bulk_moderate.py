@@ -0,0 +1,250 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from media_types import modality_of
+
+
+MODALITIES = ("image", "video", "audio")
+
+def _item(path, item_id=None, modality=None):
+    # Ids are compared with the ones read back from the checkpoint file, so they're always strings
+    item_id = path if item_id is None else str(item_id)
+    if "\n" in item_id:
+        logging.warning(f"Skipping {path}, its id {item_id!r} contains a newline")
+        return None
+    modality = modality or modality_of(path)
+    if modality is None:
+        logging.debug(f"Skipping {path}, its extension isn't a known media type")
+        return None
+    if modality not in MODALITIES:
+        logging.warning(f"Skipping {path}, invalid modality {modality}. Supported modalities are {', '.join(MODALITIES)}")
+        return None
+    return {"id": item_id, "path": path, "modality": modality}
+
+
+def iter_items(source):
+    """
+    Lazily lists the media to moderate, so millions of assets never sit in memory at once:
+        a directory: every media file under it, recursively, in sorted order
+        a .jsonl manifest: one {"path", "id" (default: path), "modality" (default: from the
+            extension)} per line, relative paths being relative to the manifest
+        anything else: a glob pattern, ** matching sub-directories
+    Yields {"id", "path", "modality"} dicts, ids must be unique within a run.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                item = _item(os.path.join(root, file_name))
+                if item is not None:
+                    yield item
+
+    elif source.endswith(".jsonl") and os.path.isfile(source):
+        manifest_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    path = entry["path"]
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"Skipping line {line_no} of {source}, expected a JSON object with a path")
+                    continue
+                item = _item(os.path.join(manifest_dir, path), entry.get("id"), entry.get("modality"))
+                if item is not None:
+                    yield item
+
+    else:
+        for path in glob.iglob(source, recursive=True):
+            if os.path.isfile(path):
+                item = _item(path)
+                if item is not None:
+                    yield item
+
+
+def read_checkpoint(checkpoint_path):
+    """The ids already moderated by an earlier run, one per line of checkpoint_path."""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+# Runs in the worker processes
+
+
+def _init_worker(intra_op_threads):
+    # Each worker is one single-threaded consumer with its own session: the micro-batcher
+    # would only add waits, and onnxruntime gets its share of the cores instead of all of them
+    os.environ.setdefault("ORT_INTRA_OP_THREADS", str(intra_op_threads))
+    os.environ.setdefault("NSFW_MICRO_BATCHING", "0")
+    logging.getLogger().setLevel(os.getenv("LOG_LEVEL", "WARNING"))
+
+    from model_registry import reset_after_fork, warmup
+
+    reset_after_fork()
+    warmup()
+
+
+def _moderate_images(items):
+    """One session.run for a batch of images coming from many files."""
+    from image_model import Classifier
+    from moderation_engine import label_predictions
+
+    try:
+        # Results are matched back to items by position, whatever their ids look like
+        result = Classifier().classify(
+            [item["path"] for item in items],
+            batch_size=len(items),
+            image_names=list(range(len(items))),
+            compact=True,
+        )
+    except Exception as ex:
+        logging.exception(ex, exc_info=True)
+        return [dict(item, error=f"{type(ex).__name__}: {ex}") for item in items]
+
+    preds = {}
+    if result:
+        preds = dict(zip(result["names"], label_predictions(result["scores"], result["categories"])))
+    records = []
+    for i, item in enumerate(items):
+        if i in preds:
+            records.append(dict(item, result=preds[i]))
+        else:
+            records.append(dict(item, error="The image couldn't be read"))
+    return records
+
+
+def _moderate_file(item):
+    from audio_model import audio_moderate
+    from video_model import video_moderate
+
+    moderate = video_moderate if item["modality"] == "video" else audio_moderate
+    try:
+        return [dict(item, result=moderate(item["path"]))]
+    except Exception as ex:
+        logging.exception(ex, exc_info=True)
+        return [dict(item, error=f"{type(ex).__name__}: {ex}")]
+
+
+def _tasks(items, image_batch_size):
+    """Groups consecutive images into batches across files, videos and audio go one by one."""
+    images = []
+    for item in items:
+        if item["modality"] == "image":
+            images.append(item)
+            if len(images) >= image_batch_size:
+                yield _moderate_images, images
+                images = []
+        else:
+            yield _moderate_file, item
+    if images:
+        yield _moderate_images, images
+
+
+def bulk_moderate(
+    source,
+    output_path,
+    checkpoint_path=None,
+    workers=None,
+    image_batch_size=32,
+    modalities=MODALITIES,
+    max_pending=None,
+):
+    """
+    Moderates every item of source (see iter_items) on a pool of worker processes, each with
+    its own ONNX session, and appends one JSON line per item to output_path:
+        {"id", "path", "modality", "result"} or {"id", "path", "modality", "error"}
+    Lines are written as items finish, so they aren't in input order. The ids of the items
+    moderated successfully go to checkpoint_path (default: output_path + ".checkpoint") after
+    their line is written, and are skipped when the run is restarted. Failed items aren't
+    checkpointed, so a restarted run retries them and appends their new line; an item that was
+    being written when the run died may also appear twice. The last line of an id is the one
+    that counts.
+
+    inputs:
+        workers: worker processes, defaults to one per core
+        image_batch_size: images from different files moderated in one inference call
+        modalities: the modalities to moderate, other items are skipped
+        max_pending: tasks in flight at once, defaults to 4 per worker
+    outputs:
+        {"done", "failed", "skipped", "seconds"} counts of this run
+    """
+    workers = workers or os.cpu_count() or 1
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+    max_pending = max_pending or 4 * workers
+    done_ids = read_checkpoint(checkpoint_path)
+    if done_ids:
+        logging.info(f"Resuming, {len(done_ids)} items are already in {checkpoint_path}")
+
+    stats = {"done": 0, "failed": 0, "skipped": 0}
+
+    def _pending_items():
+        for item in iter_items(source):
+            if item["modality"] not in modalities or item["id"] in done_ids:
+                stats["skipped"] += 1
+                continue
+            yield item
+
+    start = time.perf_counter()
+    intra_op_threads = max((os.cpu_count() or 1) // workers, 1)
+    with (
+        ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(intra_op_threads,)) as executor,
+        open(output_path, "a") as output,
+        open(checkpoint_path, "a") as checkpoint,
+    ):
+
+        def _write(records):
+            for record in records:
+                output.write(json.dumps(record, default=str) + "\n")
+                stats["failed" if "error" in record else "done"] += 1
+            output.flush()
+            checkpoint.write("".join(record["id"] + "\n" for record in records if "error" not in record))
+            checkpoint.flush()
+
+        pending = set()
+        for task, payload in _tasks(_pending_items(), image_batch_size):
+            if len(pending) >= max_pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    _write(future.result())
+                logging.info(f"{stats['done'] + stats['failed']} items moderated, {time.perf_counter() - start:.1f}s")
+            pending.add(executor.submit(task, payload))
+
+        for future in wait(pending).done:
+            _write(future.result())
+
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moderate a directory, glob or JSONL manifest of media files offline")
+    parser.add_argument("source", help="a directory, a .jsonl manifest or a glob pattern (quote it)")
+    parser.add_argument("--output", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--checkpoint", help="ids moderated successfully, to resume an interrupted run (default: OUTPUT.checkpoint)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--image-batch-size", type=int, default=32)
+    parser.add_argument("--modality", dest="modalities", action="append", choices=MODALITIES, help="repeatable (default: all)")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+    stats = bulk_moderate(
+        args.source,
+        args.output,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        image_batch_size=args.image_batch_size,
+        modalities=args.modalities or MODALITIES,
+    )
+    print(json.dumps(stats))
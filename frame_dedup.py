@@ -0,0 +1,135 @@
+import os
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+DEDUP_METRICS = ("ssim", "phash", "mad")
+
+# Every metric is turned into a similarity score in [0, 1], frames scoring at or
+# above the threshold are duplicates. phash scores 1 - hamming_distance / 64,
+# mad scores 1 - mean_absolute_difference / 255.
+DEFAULT_THRESHOLDS = {"ssim": 0.5, "phash": 0.9, "mad": 0.95}
+
+_SSIM_WIN_SIZE = 7
+_SSIM_COV_NORM = _SSIM_WIN_SIZE**2 / (_SSIM_WIN_SIZE**2 - 1)
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+_POPCOUNT_8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _window_means(x):
+    """Mean of every valid 7x7 window over the last two axes, via integral images."""
+    integral = np.pad(x, [(0, 0)] * (x.ndim - 2) + [(1, 0), (1, 0)]).cumsum(-2).cumsum(-1)
+    w = _SSIM_WIN_SIZE
+    sums = integral[..., w:, w:] - integral[..., :-w, w:] - integral[..., w:, :-w] + integral[..., :-w, :-w]
+    return sums / (w * w)
+
+
+def thumbnail(frame, resize_to=(64, 64)):
+    """The first channel of the resized frame, exactly what is_similar_frame compares."""
+    if resize_to:
+        frame = cv2.resize(frame, resize_to)
+    if len(frame.shape) == 3:
+        frame = frame[:, :, 0]
+    return frame
+
+
+def phash(thumb):
+    """64-bit DCT perceptual hash of a grayscale thumbnail."""
+    small = cv2.resize(thumb, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8].flatten()
+    bits = low_freq > np.median(low_freq[1:])
+    return np.packbits(bits).view(">u8")[0]
+
+
+def hamming_distances(hashes, query):
+    """Hamming distance between query and every 64-bit hash of the hashes array."""
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(query))
+    return _POPCOUNT_8[xor.reshape(-1, 1).view(np.uint8)].sum(axis=1)
+
+
+class FrameSignature:
+    """
+    Everything a metric needs to compare a frame, computed once per frame
+    instead of once per comparison.
+    """
+
+    def __init__(self, frame, metric, resize_to=(64, 64)):
+        thumb = thumbnail(frame, resize_to)
+        if metric == "phash":
+            self.hash = phash(thumb)
+        else:
+            self.thumb = thumb.astype(np.float64)
+        if metric == "ssim":
+            self.mean = _window_means(self.thumb)
+            self.var = _SSIM_COV_NORM * (_window_means(self.thumb * self.thumb) - self.mean * self.mean)
+
+
+def similarity_scores(metric, signature, context):
+    """Scores signature against a list of context signatures in one vectorized pass."""
+    if metric == "phash":
+        return 1 - hamming_distances([c.hash for c in context], signature.hash) / 64
+
+    thumbs = np.stack([c.thumb for c in context])
+    if metric == "mad":
+        return 1 - np.abs(thumbs - signature.thumb).mean(axis=(1, 2)) / 255
+
+    # Same arithmetic as skimage.metrics.structural_similarity with its defaults
+    # (7x7 uniform window, sample covariance), batched over the context frames
+    means = np.stack([c.mean for c in context])
+    variances = np.stack([c.var for c in context])
+    covariances = _SSIM_COV_NORM * (_window_means(thumbs * signature.thumb) - means * signature.mean)
+
+    numerator = (2 * means * signature.mean + _SSIM_C1) * (2 * covariances + _SSIM_C2)
+    denominator = (means**2 + signature.mean**2 + _SSIM_C1) * (variances + signature.var + _SSIM_C2)
+    return (numerator / denominator).mean(axis=(1, 2))
+
+
+class FrameDeduplicator:
+    """
+    Keeps a frame only if it isn't similar to any of the last context_n_frames kept frames.
+    The metric defaults to FRAME_DEDUP_METRIC. The metrics have different scales, so each has
+    its own threshold setting, FRAME_SIMILARITY_THRESH_SSIM, _PHASH or _MAD, which overrides
+    thresh; FRAME_SIMILARITY_THRESH still sets the SSIM one. Both are read once when the
+    deduplicator is created.
+
+    dedup = FrameDeduplicator()
+    important_frames = [frame for frame in frames if dedup.add(frame)]
+    """
+
+    def __init__(self, metric=None, thresh=None, context_n_frames=3, resize_to=(64, 64)):
+        metric = metric or os.getenv("FRAME_DEDUP_METRIC", "ssim")
+        if metric not in DEDUP_METRICS:
+            raise ValueError(
+                "Invalid frame dedup metric {} specified. Supported "
+                "metrics are {}".format(metric, ", ".join(DEDUP_METRICS))
+            )
+        if thresh is None:
+            thresh = DEFAULT_THRESHOLDS[metric]
+        env_thresh = os.getenv(f"FRAME_SIMILARITY_THRESH_{metric.upper()}")
+        if env_thresh is None and metric == "ssim":
+            env_thresh = os.getenv("FRAME_SIMILARITY_THRESH")
+
+        self.metric = metric
+        self.thresh = float(env_thresh if env_thresh is not None else thresh)
+        self.resize_to = resize_to
+        self.context = deque(maxlen=context_n_frames)
+
+    def scores(self, frame):
+        """Similarity of frame to each context frame, most recent last."""
+        signature = FrameSignature(frame, self.metric, self.resize_to)
+        if not self.context:
+            return signature, np.empty(0)
+        return signature, similarity_scores(self.metric, signature, self.context)
+
+    def add(self, frame):
+        """Returns True and remembers the frame if it isn't a duplicate of the context frames."""
+        signature, scores = self.scores(frame)
+        if np.any(scores >= self.thresh):
+            return False
+
+        self.context.append(signature)
+        return True
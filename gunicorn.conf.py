@@ -0,0 +1,54 @@
+import os
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# gunicorn -c gunicorn.conf.py app:app
+bind = f"{os.getenv('HOST') or '0.0.0.0'}:{os.getenv('PORT') or 7001}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+# Threads beyond MAX_CONCURRENT_REQUESTS only answer 429s and GETs
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+graceful_timeout = 30
+limit_request_line = 8190
+
+# Import the app and read the ONNX model bytes in the master, so workers share them copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    import glob
+    import tempfile
+
+    from app import preload_models
+    from job_queue import requeue_stale_jobs
+
+    # Each worker process has its own memory job queue, a job polled on another worker would 404
+    if workers > 1 and os.getenv("JOB_QUEUE_BACKEND", "sqlite") == "memory":
+        raise ValueError(f"Invalid job queue backend memory specified for {workers} workers. Supported backends are sqlite")
+
+    # Workers publish their metrics here so /metrics covers all of them, see metrics.py
+    metrics_dir = os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "moderation-metrics"))
+    for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json")):
+        os.remove(path)
+
+    preload_models()
+    # Once, here: in post_fork a restarted worker would requeue jobs the other workers are running
+    requeue_stale_jobs()
+
+
+def post_fork(server, worker):
+    # onnxruntime sessions, batcher threads and torch's thread pools don't survive fork(), each
+    # worker builds its own sessions and loads its own Whisper pool
+    from audio_model import load_whisper_models
+    from job_queue import get_job_queue
+    from model_registry import reset_after_fork, warmup
+
+    reset_after_fork()
+    warmup()
+    load_whisper_models()
+    # Every worker drains the shared sqlite job queue
+    get_job_queue()
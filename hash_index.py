@@ -0,0 +1,438 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image as pil_image
+
+from frame_dedup import _POPCOUNT_8, hamming_distances, phash
+from media_types import modality_of
+
+
+VERDICTS = ("unsafe", "safe")
+
+# Each 64-bit pHash is split into 4 16-bit chunks, each with its own sorted lookup table.
+# Two hashes within distance d have at least one chunk within d // 4 bits of each other,
+# so only the entries in the tables' buckets near the query's chunks need checking.
+N_CHUNKS = 4
+CHUNK_BITS = 64 // N_CHUNKS
+
+# Hashes with this few (or this many) bits set come from flat images, e.g. a blank frame,
+# which all hash alike and would match each other
+MIN_HASH_BITS = 8
+
+LABEL_DTYPE = "S64"
+
+_INDEX_FILES = ("phash", "dhash", "verdicts", "labels", "chunk_keys", "chunk_order")
+
+_chunk_popcounts = _POPCOUNT_8[np.arange(1 << CHUNK_BITS) & 0xFF] + _POPCOUNT_8[np.arange(1 << CHUNK_BITS) >> 8]
+_flip_masks = {}
+
+_hash_index = None
+_hash_index_lock = threading.Lock()
+_hash_index_checked_at = 0.0
+
+
+def grayscale(image):
+    """A PIL image or a BGR(A) frame as read by cv2, as a 2D uint8 array."""
+    if isinstance(image, pil_image.Image):
+        return np.asarray(image.convert("L"))
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def dhash(gray):
+    """64-bit difference hash: whether each pixel of a 9x8 thumbnail is brighter than its left neighbour."""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = small[:, 1:] > small[:, :-1]
+    return np.packbits(bits).view(">u8")[0]
+
+
+def image_hashes(image):
+    """(pHash, dHash) of a PIL image or BGR frame, None if it's too flat to hash reliably."""
+    gray = grayscale(image)
+    image_phash = phash(gray)
+    set_bits = bin(int(image_phash)).count("1")
+    if set_bits < MIN_HASH_BITS or set_bits > 64 - MIN_HASH_BITS:
+        return None
+    return np.uint64(image_phash), np.uint64(dhash(gray))
+
+
+def verdict_scores(verdict, categories):
+    """The scores row standing in for the classifier's on a match: 1 for the verdict, 0 for the rest."""
+    if verdict not in categories:
+        return None
+    return np.asarray([1.0 if category == verdict else 0.0 for category in categories], dtype=np.float32)
+
+
+def _chunks(hashes):
+    """(N_CHUNKS, N) uint16 chunks of 64-bit hashes, least significant first."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    mask = np.uint64((1 << CHUNK_BITS) - 1)
+    return np.stack([((hashes >> np.uint64(CHUNK_BITS * i)) & mask).astype(np.uint16) for i in range(N_CHUNKS)])
+
+
+def _masks_within(radius):
+    """Every CHUNK_BITS-bit value with at most radius bits set, to probe the buckets around a chunk."""
+    masks = _flip_masks.get(radius)
+    if masks is None:
+        masks = _flip_masks[radius] = np.flatnonzero(_chunk_popcounts <= radius).astype(np.uint16)
+    return masks
+
+
+def current_version(path):
+    """Name of the saved version path's CURRENT file points at, None if nothing was saved yet."""
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+class HashIndex:
+    """
+    Perceptual hashes of images and video frames moderators have already ruled on, each with a
+    verdict ("unsafe" for known-bad, "safe" for known-good) and a label, e.g. an asset id.
+    A lookup is a match when both the pHash and the dHash are within max_distance bits, so a
+    re-encoded, resized or slightly recompressed copy still gets the stored verdict.
+
+    Saved indexes are memory-mapped, so opening one is instant and every worker process shares
+    the pages. Entries added or removed since are kept in memory until save() writes a new
+    version next to the old one and switches the directory's CURRENT file to it.
+
+    index = HashIndex.open("./hash_index")
+    index.add(image, "unsafe", "asset-123")
+    index.save()
+    index.lookup(image)  # ("unsafe", "asset-123", 0)
+    """
+
+    def __init__(self, path=None, version=None, arrays=None):
+        self.path = path
+        self.version = version
+        if arrays is None:
+            arrays = {
+                "phash": np.empty(0, dtype=np.uint64),
+                "dhash": np.empty(0, dtype=np.uint64),
+                "verdicts": np.empty(0, dtype=np.int8),
+                "labels": np.empty(0, dtype=LABEL_DTYPE),
+                "chunk_keys": np.empty((N_CHUNKS, 0), dtype=np.uint16),
+                "chunk_order": np.empty((N_CHUNKS, 0), dtype=np.uint32),
+            }
+        self._saved = arrays
+        self._added = []
+        self._removed = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps the current version saved in the path directory, or starts an empty index."""
+        version = current_version(path)
+        if version is None:
+            return cls(path)
+        arrays = {name: np.load(os.path.join(path, version, f"{name}.npy"), mmap_mode="r") for name in _INDEX_FILES}
+        return cls(path, version, arrays)
+
+    def __len__(self):
+        with self._lock:
+            n_saved = len(self._saved["phash"])
+            if self._removed:
+                n_saved -= int(np.isin(self._saved["labels"], list(self._removed)).sum())
+            return n_saved + len(self._added)
+
+    def info(self):
+        """
+        Entry counts as lookups see them, the saved entries less the removed labels plus the
+        added ones, and how many of those changes are pending until the next save().
+        """
+        with self._lock:
+            verdicts = np.asarray(self._saved["verdicts"])
+            if self._removed:
+                removed = np.isin(self._saved["labels"], list(self._removed))
+                n_removed = int(removed.sum())
+                verdicts = verdicts[~removed]
+            else:
+                n_removed = 0
+            counts = {verdict: int((verdicts == i).sum()) for i, verdict in enumerate(VERDICTS)}
+            for entry in self._added:
+                counts[VERDICTS[entry[2]]] += 1
+            return {
+                "version": self.version,
+                "entries": sum(counts.values()),
+                "verdicts": counts,
+                "pending": {"added": len(self._added), "removed": n_removed, "removed_labels": len(self._removed)},
+            }
+
+    def add(self, image, verdict, label):
+        """Adds a PIL image or BGR frame. Returns False for images too flat to hash reliably."""
+        hashes = image_hashes(image)
+        if hashes is None:
+            return False
+        self.add_hashes(hashes[0], hashes[1], verdict, label)
+        return True
+
+    def add_hashes(self, image_phash, image_dhash, verdict, label):
+        if verdict not in VERDICTS:
+            raise ValueError("Invalid verdict {} specified. Supported verdicts are {}".format(verdict, ", ".join(VERDICTS)))
+        encoded_label = label.encode("utf-8")
+        if len(encoded_label) > np.dtype(LABEL_DTYPE).itemsize:
+            raise ValueError(f"Label {label} is longer than {np.dtype(LABEL_DTYPE).itemsize} bytes")
+
+        with self._lock:
+            self._added.append((np.uint64(image_phash), np.uint64(image_dhash), VERDICTS.index(verdict), encoded_label))
+
+    def remove(self, label):
+        """
+        Removes every entry with label, returns how many there were. Saved entries are hidden
+        straight away and dropped by the next save(); entries added with the label afterwards are kept.
+        """
+        encoded_label = label.encode("utf-8")
+        with self._lock:
+            n_added = len(self._added)
+            self._added = [entry for entry in self._added if entry[3] != encoded_label]
+            removed = n_added - len(self._added)
+            if encoded_label not in self._removed:
+                removed += int((self._saved["labels"] == encoded_label).sum())
+            self._removed.add(encoded_label)
+        return removed
+
+    def _saved_candidates(self, query_phash, max_distance):
+        """Rows of the saved index that may be within max_distance of query_phash."""
+        keys = self._saved["chunk_keys"]
+        if not keys.shape[1]:
+            return np.empty(0, dtype=np.int64)
+
+        probes_mask = _masks_within(max_distance // N_CHUNKS)
+        candidates = []
+        for i, query_chunk in enumerate(_chunks([query_phash])[:, 0]):
+            probes = np.bitwise_xor(probes_mask, query_chunk)
+            starts = np.searchsorted(keys[i], probes, side="left")
+            lengths = np.searchsorted(keys[i], probes, side="right") - starts
+            # Positions of every bucket's entries in the sorted table, without a loop over buckets
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+            candidates.append(self._saved["chunk_order"][i][positions])
+        # An entry close in several chunks shows up more than once, which only costs a repeated comparison
+        return np.concatenate(candidates)
+
+    def lookup_hashes(self, image_phash, image_dhash, max_distance=None):
+        """
+        The closest entry whose pHash and dHash are both within max_distance bits
+        (HASH_INDEX_MAX_DISTANCE, default 6) of the query's.
+        outputs:
+            (verdict, label, distance) of the best match, None without one
+        """
+        if max_distance is None:
+            max_distance = int(os.getenv("HASH_INDEX_MAX_DISTANCE", 6))
+
+        with self._lock:
+            removed = list(self._removed)
+            added = list(self._added)
+
+        best = None
+        rows = self._saved_candidates(image_phash, max_distance)
+        if len(rows):
+            distances = np.maximum(
+                hamming_distances(self._saved["phash"][rows], image_phash),
+                hamming_distances(self._saved["dhash"][rows], image_dhash),
+            )
+            close = distances <= max_distance
+            if removed:
+                close &= ~np.isin(self._saved["labels"][rows], removed)
+            if close.any():
+                i = np.flatnonzero(close)[np.argmin(distances[close])]
+                best = (int(distances[i]), self._saved["verdicts"][rows[i]], self._saved["labels"][rows[i]])
+
+        if added:
+            distances = np.maximum(
+                hamming_distances([entry[0] for entry in added], image_phash),
+                hamming_distances([entry[1] for entry in added], image_dhash),
+            )
+            i = int(np.argmin(distances))
+            if distances[i] <= max_distance and (best is None or distances[i] < best[0]):
+                best = (int(distances[i]), added[i][2], added[i][3])
+
+        if best is None:
+            return None
+        distance, verdict, label = best
+        return VERDICTS[int(verdict)], bytes(label).decode("utf-8"), distance
+
+    def lookup(self, image, max_distance=None):
+        """lookup_hashes for a PIL image or BGR frame."""
+        hashes = image_hashes(image)
+        if hashes is None:
+            return None
+        return self.lookup_hashes(hashes[0], hashes[1], max_distance)
+
+    def known_scores(self, items, categories):
+        """
+        {position in items: scores row} for the decoded images or frames that match an entry,
+        see verdict_scores. Items that aren't decoded images (paths, streams) are left to the classifier.
+        """
+        known = {}
+        for i, item in enumerate(items):
+            if not isinstance(item, (np.ndarray, pil_image.Image)):
+                continue
+            match = self.lookup(item)
+            if match is None:
+                continue
+            scores = verdict_scores(match[0], categories)
+            if scores is not None:
+                logging.debug(f"Item {i} matches {match[1]} ({match[0]}) at distance {match[2]}")
+                known[i] = scores
+        return known
+
+    def save(self, path=None):
+        """
+        Writes the current entries as a new version under path (default: where the index was opened)
+        and points CURRENT at it. Older versions are deleted; processes that still have them mapped
+        keep reading them until they reopen the index.
+        """
+        path = path or self.path
+        if not path:
+            raise ValueError("The index has no path to be saved to")
+        os.makedirs(path, exist_ok=True)
+
+        with self._lock:
+            keep = np.ones(len(self._saved["phash"]), dtype=bool)
+            if self._removed:
+                keep &= ~np.isin(self._saved["labels"], list(self._removed))
+            added = self._added
+            phashes = np.concatenate([self._saved["phash"][keep], np.asarray([e[0] for e in added], dtype=np.uint64)])
+            dhashes = np.concatenate([self._saved["dhash"][keep], np.asarray([e[1] for e in added], dtype=np.uint64)])
+            verdicts = np.concatenate([self._saved["verdicts"][keep], np.asarray([e[2] for e in added], dtype=np.int8)])
+            labels = np.concatenate([self._saved["labels"][keep], np.asarray([e[3] for e in added], dtype=LABEL_DTYPE)])
+
+            chunks = _chunks(phashes)
+            order = np.argsort(chunks, axis=1, kind="stable").astype(np.uint32)
+            arrays = {
+                "phash": phashes,
+                "dhash": dhashes,
+                "verdicts": verdicts,
+                "labels": labels,
+                "chunk_keys": np.take_along_axis(chunks, order.astype(np.int64), axis=1),
+                "chunk_order": order,
+            }
+
+            version_dir = tempfile.mkdtemp(dir=path, prefix="v-")
+            for name, array in arrays.items():
+                np.save(os.path.join(version_dir, f"{name}.npy"), array)
+            version = os.path.basename(version_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(version)
+            os.replace(tmp_path, os.path.join(path, "CURRENT"))
+
+            for name in os.listdir(path):
+                if name.startswith("v-") and name != version:
+                    shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+            reopened = HashIndex.open(path)
+            self.path = path
+            self.version = version
+            self._saved = reopened._saved
+            self._added = []
+            self._removed = set()
+        return version
+
+
+def get_hash_index():
+    """
+    Returns the process-wide HashIndex saved at HASH_INDEX_PATH, None when it isn't set.
+    Every HASH_INDEX_RELOAD_SECONDS (default 10) the index directory is checked for a newer
+    version, e.g. one saved by the operator CLI, which is then mapped in its place.
+    """
+    global _hash_index, _hash_index_checked_at
+    path = os.getenv("HASH_INDEX_PATH")
+    if not path:
+        return None
+
+    reload_seconds = float(os.getenv("HASH_INDEX_RELOAD_SECONDS", 10))
+    if _hash_index is not None and time.monotonic() - _hash_index_checked_at < reload_seconds:
+        return _hash_index
+
+    with _hash_index_lock:
+        if _hash_index is None or time.monotonic() - _hash_index_checked_at >= reload_seconds:
+            _hash_index_checked_at = time.monotonic()
+            if _hash_index is None or _hash_index.path != path or _hash_index.version != current_version(path):
+                logging.info(f"Opening hash index {path} version {current_version(path)}")
+                _hash_index = HashIndex.open(path)
+
+    return _hash_index
+
+
+def _iter_media_images(path):
+    """The image at path, or the deduplicated sampled frames if it's a video, as (name, image) pairs."""
+    from media_demux import VideoDemuxer
+    from moderation_engine import decode_video_frames, dedupe_frames
+
+    if modality_of(path) != "video":
+        image = pil_image.open(path)
+        image.load()
+        yield path, image
+        return
+
+    demuxer = VideoDemuxer(path)
+    try:
+        for frame_i, frame in dedupe_frames()(decode_video_frames(demuxer)):
+            yield f"{path}#{frame_i}", frame
+    finally:
+        demuxer.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the perceptual-hash index of already moderated media")
+    parser.add_argument("--index", default=os.getenv("HASH_INDEX_PATH", "./hash_index"), help="index directory (default: HASH_INDEX_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="add images, or the sampled frames of videos, with a verdict")
+    add.add_argument("paths", nargs="+")
+    add.add_argument("--verdict", choices=VERDICTS, required=True)
+    add.add_argument("--label", help="label of the entries, e.g. an asset id (default: each file's name)")
+
+    remove = commands.add_parser("remove", help="remove every entry with a label")
+    remove.add_argument("labels", nargs="+")
+
+    lookup = commands.add_parser("lookup", help="show the matches of images or video frames")
+    lookup.add_argument("paths", nargs="+")
+    lookup.add_argument("--max-distance", type=int, default=None)
+
+    commands.add_parser("info", help="entry counts of the index")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    index = HashIndex.open(args.index)
+
+    if args.command == "add":
+        added = skipped = 0
+        for path in args.paths:
+            for name, image in _iter_media_images(path):
+                if index.add(image, args.verdict, args.label or os.path.basename(path)):
+                    added += 1
+                else:
+                    logging.warning(f"Skipping {name}, it's too flat to hash reliably")
+                    skipped += 1
+        version = index.save()
+        print(json.dumps({"added": added, "skipped": skipped, "entries": len(index), "version": version}))
+
+    elif args.command == "remove":
+        removed = sum(index.remove(label) for label in args.labels)
+        version = index.save()
+        print(json.dumps({"removed": removed, "entries": len(index), "version": version}))
+
+    elif args.command == "lookup":
+        for path in args.paths:
+            for name, image in _iter_media_images(path):
+                match = index.lookup(image, args.max_distance)
+                print(json.dumps({"name": name, "match": dict(zip(("verdict", "label", "distance"), match)) if match else None}))
+
+    else:
+        print(json.dumps({"path": args.index, **index.info()}))
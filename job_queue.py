@@ -0,0 +1,394 @@
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from urllib.parse import urlparse
+
+import numpy as np
+import requests
+
+from audio_model import audio_moderate
+from metrics import track
+from result_cache import store
+from video_model import video_moderate
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def _new_job(modality, media_path, content_hash, callback_url):
+    return {
+        "id": uuid.uuid4().hex,
+        "modality": modality,
+        "media_path": media_path,
+        "content_hash": content_hash,
+        "callback_url": callback_url,
+        "status": "queued",
+        "result": None,
+        "error": None,
+        "submitted_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+    }
+
+
+class MemoryJobStore:
+    """Jobs kept in this process only, lost on restart."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._queued = []
+        self._condition = threading.Condition()
+
+    def add(self, job):
+        with self._condition:
+            self._jobs[job["id"]] = job
+            if job["status"] == "queued":
+                self._queued.append(job["id"])
+                self._condition.notify()
+
+    def claim(self, timeout):
+        with self._condition:
+            if not self._queued:
+                self._condition.wait(timeout)
+            if not self._queued:
+                return None
+            job = self._jobs[self._queued.pop(0)]
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            return dict(job)
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._condition:
+            job = self._jobs[job_id]
+            job.update(status=status, result=result, error=error, finished_at=time.time())
+
+    def get(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def counts(self):
+        with self._condition:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+    def recent_finished(self, n):
+        with self._condition:
+            finished = [job for job in self._jobs.values() if job["finished_at"] and job["started_at"]]
+        finished.sort(key=lambda job: job["finished_at"])
+        return [(job["submitted_at"], job["started_at"], job["finished_at"]) for job in finished[-n:]]
+
+    def requeue_stale(self, max_age):
+        pass
+
+
+class SQLiteJobStore:
+    """
+    Jobs kept in a local SQLite file, shared by every worker process on the host and
+    surviving restarts. Each call opens its own connection, so threads never share one.
+    """
+
+    _COLUMNS = (
+        "id",
+        "modality",
+        "media_path",
+        "content_hash",
+        "callback_url",
+        "status",
+        "result",
+        "error",
+        "submitted_at",
+        "started_at",
+        "finished_at",
+    )
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, modality TEXT, media_path TEXT, "
+                "content_hash TEXT, callback_url TEXT, status TEXT, result TEXT, error TEXT, "
+                "submitted_at REAL, started_at REAL, finished_at REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at)")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _to_job(self, row):
+        job = dict(zip(self._COLUMNS, row))
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def add(self, job):
+        row = dict(job, result=json.dumps(job["result"]) if job["result"] is not None else None)
+        with closing(self._connect()) as connection:
+            connection.execute(
+                f"INSERT INTO jobs ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                [row[column] for column in self._COLUMNS],
+            )
+
+    def claim(self, timeout):
+        connection = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, so two workers can't claim the same job
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE status = 'queued' ORDER BY submitted_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                started_at = time.time()
+                connection.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (started_at, row[0]))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+        if row is None:
+            time.sleep(timeout)
+            return None
+
+        job = self._to_job(row)
+        job.update(status="running", started_at=started_at)
+        return job
+
+    def finish(self, job_id, status, result=None, error=None):
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def get(self, job_id):
+        with closing(self._connect()) as connection:
+            row = connection.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def counts(self):
+        with closing(self._connect()) as connection:
+            return dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def recent_finished(self, n):
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT submitted_at, started_at, finished_at FROM jobs WHERE finished_at IS NOT NULL "
+                "AND started_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?",
+                (n,),
+            ).fetchall()
+        return rows[::-1]
+
+    def requeue_stale(self, max_age):
+        """Puts back jobs left running by a worker that died mid-job."""
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running' AND started_at < ?",
+                (time.time() - max_age,),
+            )
+
+
+def validate_callback_url(url):
+    """
+    Raises ValueError unless the server may POST a finished job to url: http(s) only, and the
+    host must be in JOB_CALLBACK_ALLOWLIST (comma separated host names) when it is set, or else
+    resolve to public addresses only, so clients can't reach loopback, private or link-local services.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError(f"Invalid callback url {url} specified. Supported callback urls are http and https urls")
+
+    allowlist = [host.strip().lower() for host in os.getenv("JOB_CALLBACK_ALLOWLIST", "").split(",") if host.strip()]
+    if allowlist:
+        if parsed.hostname.lower() not in allowlist:
+            raise ValueError(f"Invalid callback host {parsed.hostname} specified. Supported callback hosts are {', '.join(allowlist)}")
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, parsed.port or 80, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise ValueError(f"Invalid callback url {url} specified, its host doesn't resolve")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        ip = getattr(ip, "ipv4_mapped", None) or ip
+        if not ip.is_global:
+            raise ValueError(f"Invalid callback url {url} specified, {parsed.hostname} resolves to the non-public address {ip}")
+
+
+def _summary(durations):
+    if not durations:
+        return {"count": 0}
+    durations = np.asarray(durations)
+    return {
+        "count": len(durations),
+        "mean": float(durations.mean()),
+        "p50": float(np.percentile(durations, 50)),
+        "p95": float(np.percentile(durations, 95)),
+        "max": float(durations.max()),
+    }
+
+
+class JobQueue:
+    """
+    Accepts long audio/video moderation jobs and runs them on background worker threads.
+
+    inputs:
+        store: MemoryJobStore or SQLiteJobStore
+        handlers: dict of modality -> callable(media_path) returning the moderation result
+        n_workers: number of worker threads pulling from the store in this process
+        on_result: called with (job, result) after a job succeeds, e.g. to fill a result cache
+    """
+
+    def __init__(self, store, handlers, n_workers=1, poll_interval=0.5, on_result=None):
+        self.store = store
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.on_result = on_result
+        self._workers = []
+        for i in range(n_workers):
+            worker = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, modality, media_path, content_hash=None, callback_url=None, result=None):
+        """
+        Queues a job and returns its id. A job submitted with a ready result, e.g. a
+        cache hit, is stored as done straight away and its media file is removed.
+        """
+        if modality not in self.handlers:
+            raise ValueError(f"Invalid job modality {modality} specified. Supported modalities are {', '.join(self.handlers)}")
+
+        job = _new_job(modality, media_path, content_hash, callback_url)
+        if result is not None:
+            now = time.time()
+            job.update(status="done", result=result, started_at=now, finished_at=now)
+            _remove(media_path)
+        self.store.add(job)
+        if result is not None and callback_url:
+            # Not in the submitting request, a slow callback receiver mustn't hold it up
+            threading.Thread(target=self._notify, args=(job,), name=f"job-callback-{job['id']}", daemon=True).start()
+        return job["id"]
+
+    def get(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {key: job[key] for key in ("id", "modality", "status", "result", "error", "submitted_at", "started_at", "finished_at")}
+
+    def stats(self, n_recent=1000):
+        """Queue depth, job counts per status, and wait/processing time over the last n_recent jobs."""
+        counts = self.store.counts()
+        recent = self.store.recent_finished(n_recent)
+        return {
+            "depth": counts.get("queued", 0),
+            "counts": counts,
+            "wait_seconds": _summary([started - submitted for submitted, started, _ in recent]),
+            "processing_seconds": _summary([finished - started for _, started, finished in recent]),
+        }
+
+    def _work(self):
+        while True:
+            try:
+                job = self.store.claim(self.poll_interval)
+            except Exception as ex:
+                logging.exception(ex, exc_info=True)
+                time.sleep(self.poll_interval)
+                continue
+            if job is not None:
+                self._run(job)
+
+    def _run(self, job):
+        logging.info(f"Job {job['id']} ({job['modality']}) started after {job['started_at'] - job['submitted_at']:.2f}s in queue")
+        try:
+            with track(job["modality"], request_id=job["id"]):
+                result = self.handlers[job["modality"]](job["media_path"])
+            job.update(status="done", result=result)
+            if self.on_result is not None:
+                self.on_result(job, result)
+        except Exception as ex:
+            logging.exception(ex, exc_info=True)
+            job.update(status="failed", error=str(ex))
+        finally:
+            _remove(job["media_path"])
+
+        self.store.finish(job["id"], job["status"], result=job["result"], error=job["error"])
+        self._notify(job)
+
+    def _notify(self, job):
+        if not job["callback_url"]:
+            return
+        try:
+            # Checked again here, the host may resolve elsewhere by the time the job is done
+            validate_callback_url(job["callback_url"])
+            requests.post(
+                job["callback_url"],
+                json={key: job[key] for key in ("id", "modality", "status", "result", "error")},
+                timeout=float(os.getenv("JOB_CALLBACK_TIMEOUT", 10)),
+                allow_redirects=False,
+            )
+        except Exception as ex:
+            logging.error(f"Callback for job {job['id']} to {job['callback_url']} failed: {ex}")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _job_store():
+    backend = os.getenv("JOB_QUEUE_BACKEND", "sqlite")
+    if backend == "memory":
+        return MemoryJobStore()
+    if backend == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_QUEUE_DB", "./jobs.sqlite3"))
+    raise ValueError(f"Invalid job queue backend {backend} specified. Supported backends are memory, sqlite")
+
+
+def requeue_stale_jobs():
+    """
+    Puts back the jobs left running by a server that died, running for over JOB_STALE_SECONDS
+    (sqlite only). Call it once at server startup, before any worker claims jobs, never from a
+    worker: a restarted worker would requeue jobs its siblings are still running.
+    """
+    _job_store().requeue_stale(float(os.getenv("JOB_STALE_SECONDS", 3600)))
+
+
+def get_job_queue():
+    """
+    Returns the process-wide JobQueue, starting its workers on first use.
+    JOB_QUEUE_BACKEND: "sqlite" (default, JOB_QUEUE_DB, default ./jobs.sqlite3), shared by every
+        worker process of the host, or "memory", only usable with a single worker process
+    JOB_WORKERS: worker threads per process (default 1)
+    """
+    global _job_queue
+    if _job_queue is not None:
+        return _job_queue
+
+    with _job_queue_lock:
+        if _job_queue is None:
+            job_store = _job_store()
+
+            def _cache_result(job, result):
+                if job["content_hash"]:
+                    store(job["modality"], job["content_hash"], result)
+
+            _job_queue = JobQueue(
+                job_store,
+                {"audio": audio_moderate, "video": video_moderate},
+                n_workers=int(os.getenv("JOB_WORKERS", 1)),
+                poll_interval=float(os.getenv("JOB_POLL_INTERVAL", 0.5)),
+                on_result=_cache_result,
+            )
+
+    return _job_queue
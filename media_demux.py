@@ -0,0 +1,301 @@
+import contextvars
+import logging
+import queue
+import re
+import subprocess
+import threading
+
+import cv2
+import imageio_ffmpeg
+import numpy as np
+
+from metrics import timed
+
+AUDIO_SAMPLE_RATE = 16000
+
+FRAME_SAMPLING_STRATEGIES = ("interval", "fixed", "fps", "keyframes")
+
+_SHOWINFO_PTS_TIME = re.compile(r"pts_time:\s*([-0-9.]+)")
+
+
+def _pcm_command(media_path, sample_rate):
+    """ffmpeg command writing the audio of media_path to stdout as mono 16-bit PCM at sample_rate."""
+    return [
+        imageio_ffmpeg.get_ffmpeg_exe(),
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-i",
+        media_path,
+        "-vn",
+        "-f",
+        "s16le",
+        "-acodec",
+        "pcm_s16le",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "pipe:1",
+    ]
+
+
+def decode_audio_pcm(media_path, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Decodes the audio stream of media_path to mono float32 PCM in memory.
+    Returns None when the file has no audio stream.
+    """
+    cmd = _pcm_command(media_path, sample_rate)
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    if not process.stdout:
+        logging.info(f"No audio decoded from {media_path}: {process.stderr.decode(errors='ignore').strip()}")
+        return None
+
+    return np.frombuffer(process.stdout, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def iter_audio_windows(media_path, window_seconds, overlap_seconds, sample_rate=AUDIO_SAMPLE_RATE):
+    """
+    Streams the audio of media_path from ffmpeg as overlapping windows of mono float32 PCM.
+    Yields (start_seconds, samples); only the current window is ever held in memory.
+    The last window is shorter when the audio doesn't end on a window boundary.
+    """
+    window = int(window_seconds * sample_rate)
+    hop = window - int(overlap_seconds * sample_rate)
+    if hop <= 0:
+        raise ValueError("overlap_seconds must be shorter than window_seconds")
+
+    cmd = _pcm_command(media_path, sample_rate)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    buffer = np.empty(0, dtype=np.float32)
+    start = 0
+    try:
+        while True:
+            chunk = process.stdout.read(hop * 2)
+            chunk = chunk[: len(chunk) - len(chunk) % 2]
+            if chunk:
+                samples = np.frombuffer(chunk, np.int16).astype(np.float32) / 32768.0
+                buffer = np.concatenate([buffer, samples])
+
+            while len(buffer) >= window:
+                yield start / sample_rate, buffer[:window]
+                buffer = buffer[hop:]
+                start += hop
+
+            if not chunk:
+                break
+
+        # Skip a tail that is only the overlap of the window already yielded
+        if len(buffer) and (start == 0 or len(buffer) > window - hop):
+            yield start / sample_rate, buffer
+    finally:
+        process.kill()
+        process.wait()
+
+
+def iter_keyframes(video_path, width, height, fps, max_frames=None):
+    """
+    Yields (frame_i, frame) for the keyframes of video_path only.
+    ffmpeg is told to skip decoding every non-key frame, and the showinfo filter
+    reports each keyframe's timestamp, from which its frame index is derived.
+    """
+    cmd = [
+        imageio_ffmpeg.get_ffmpeg_exe(),
+        "-nostdin",
+        "-loglevel",
+        "info",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        video_path,
+        "-an",
+        "-vf",
+        "showinfo",
+        "-vsync",
+        "0",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "pipe:1",
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pts_times = queue.Queue()
+
+    def _read_pts_times():
+        for line in process.stderr:
+            match = _SHOWINFO_PTS_TIME.search(line.decode(errors="ignore"))
+            if match:
+                pts_times.put(float(match.group(1)))
+
+    stderr_thread = threading.Thread(target=_read_pts_times, daemon=True)
+    stderr_thread.start()
+
+    frame_size = width * height * 3
+    n_yielded = 0
+    try:
+        while max_frames is None or n_yielded < max_frames:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+
+            try:
+                frame_i = int(round(pts_times.get(timeout=5) * fps))
+            except queue.Empty:
+                frame_i = -1
+
+            yield frame_i, np.frombuffer(buffer, np.uint8).reshape((height, width, 3))
+            n_yielded += 1
+    finally:
+        process.kill()
+        process.wait()
+        stderr_thread.join()
+
+
+class VideoDemuxer:
+    """
+    Opens a video once and shares it between the audio and visual branches.
+    Duration is probed on open, the audio track is decoded to memory by a
+    background ffmpeg pipe while frames are being read, and nothing is written to disk.
+
+    with VideoDemuxer(video_path) as demuxer:
+        demuxer.start_audio()
+        for frame_i, frame in demuxer.frames():
+            ...
+        samples = demuxer.audio()
+    """
+
+    def __init__(self, video_path, sample_rate=AUDIO_SAMPLE_RATE):
+        self.video_path = video_path
+        self.sample_rate = sample_rate
+        self.capture = cv2.VideoCapture(video_path)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.duration = self.frame_count / self.fps if self.fps else 0.0
+
+        self._audio = None
+        self._audio_thread = None
+        self._frames_read = False
+
+    def start_audio(self):
+        if self._audio_thread is None:
+            # Run in a copy of the caller's context so the decode is timed as part of its request
+            context = contextvars.copy_context()
+            self._audio_thread = threading.Thread(target=context.run, args=(self._decode_audio,), daemon=True)
+            self._audio_thread.start()
+
+    def _decode_audio(self):
+        try:
+            with timed("decode"):
+                self._audio = decode_audio_pcm(self.video_path, self.sample_rate)
+        except Exception as ex:
+            logging.exception(ex, exc_info=True)
+
+    def audio(self):
+        """Returns the decoded audio samples, or None if the video has no audio track."""
+        self.start_audio()
+        self._audio_thread.join()
+        return self._audio
+
+    def frames(self, skip_n_frames=0, strategy="interval", n_frames=None, seek_min_gap=None):
+        """
+        Yields (frame_i, frame) for the frames picked by the sampling strategy:
+            interval: every skip_n_frames-th frame
+            fixed: n_frames frames spread evenly over the whole video
+            fps: n_frames frames per second of video
+            keyframes: only the keyframes, optionally capped at n_frames
+        Frames that aren't sampled are never converted to BGR: the capture grab()s
+        past them, or seeks when the next sampled frame is more than seek_min_gap
+        frames ahead (default: two seconds of video).
+        The capture is sequential, so frames can only be iterated once.
+        """
+        if strategy not in FRAME_SAMPLING_STRATEGIES:
+            raise ValueError(
+                "Invalid frame sampling strategy {} specified. Supported "
+                "strategies are {}".format(strategy, ", ".join(FRAME_SAMPLING_STRATEGIES))
+            )
+        if self._frames_read:
+            raise RuntimeError(f"Frames of {self.video_path} have already been read")
+        self._frames_read = True
+
+        if strategy == "interval":
+            return self._interval_frames(skip_n_frames)
+
+        if strategy == "keyframes":
+            width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            return iter_keyframes(self.video_path, width, height, self.fps, max_frames=n_frames)
+
+        if not n_frames or n_frames <= 0:
+            raise ValueError(f"n_frames must be positive for the {strategy} strategy")
+
+        if strategy == "fixed":
+            targets = np.linspace(0, max(self.frame_count - 1, 0), num=int(n_frames))
+        else:
+            targets = np.arange(0, self.frame_count, max(self.fps / n_frames, 1))
+        targets = np.unique(np.round(targets).astype(int))
+
+        if seek_min_gap is None:
+            seek_min_gap = max(int(self.fps * 2), 1)
+
+        return self._target_frames(targets, seek_min_gap)
+
+    def _interval_frames(self, skip_n_frames):
+        skip_n_frames = max(int(skip_n_frames), 1)
+
+        for frame_i in range(self.frame_count + 1):
+            if frame_i % skip_n_frames != 0:
+                if not self.capture.grab():
+                    break
+                continue
+
+            read_flag, frame = self.capture.read()
+
+            if not read_flag:
+                break
+
+            yield frame_i, frame
+
+    def frames_at(self, targets, seek_min_gap=None):
+        """
+        Yields (frame_i, frame) for the given frame indices, in ascending order.
+        Unlike frames() it can be called any number of times, seeking back as needed,
+        so callers can visit a video in several passes, e.g. coarse to fine.
+        """
+        targets = np.unique(np.asarray(targets, dtype=int))
+        if seek_min_gap is None:
+            seek_min_gap = max(int(self.fps * 2), 1)
+        position = int(self.capture.get(cv2.CAP_PROP_POS_FRAMES))
+        return self._target_frames(targets, seek_min_gap, position)
+
+    def _target_frames(self, targets, seek_min_gap, position=0):
+        for target in targets:
+            if target < position or target - position > seek_min_gap:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, int(target))
+                position = target
+
+            while position < target:
+                if not self.capture.grab():
+                    return
+                position += 1
+
+            read_flag, frame = self.capture.read()
+
+            if not read_flag:
+                return
+
+            position += 1
+            yield int(target), frame
+
+    def release(self):
+        self.capture.release()
+        if self._audio_thread is not None:
+            self._audio_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
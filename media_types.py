@@ -0,0 +1,17 @@
+import os
+
+
+MODALITY_EXTENSIONS = {
+    "image": (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".gif", ".tif", ".tiff"),
+    "video": (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v", ".mpg", ".mpeg", ".wmv", ".flv"),
+    "audio": (".wav", ".mp3", ".m4a", ".aac", ".flac", ".ogg", ".opus", ".wma"),
+}
+
+
+def modality_of(path):
+    """The modality of a file from its extension, None for files that aren't media."""
+    extension = os.path.splitext(path)[1].lower()
+    for modality, extensions in MODALITY_EXTENSIONS.items():
+        if extension in extensions:
+            return modality
+    return None
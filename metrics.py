@@ -0,0 +1,261 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Per request (or job) state, copied into the threads a request fans out to
+_request_id = contextvars.ContextVar("request_id", default=None)
+_modality = contextvars.ContextVar("modality", default="unknown")
+_stage_timings = contextvars.ContextVar("stage_timings", default=None)
+# The branch threads of a request share its timings dict, updates are read-modify-writes
+_stage_timings_lock = threading.Lock()
+
+
+class Histogram:
+    """A Prometheus-style histogram with cumulative buckets, keyed by label values."""
+
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(labels): dict(series, buckets=list(series["buckets"])) for labels, series in self._series.items()}
+
+
+STAGE_SECONDS = Histogram(
+    "moderation_stage_seconds",
+    "Time spent in each pipeline stage",
+    ("modality", "stage"),
+)
+REQUEST_SECONDS = Histogram(
+    "moderation_request_seconds",
+    "End to end time of HTTP requests and queued jobs",
+    ("modality", "status"),
+)
+HISTOGRAMS = (STAGE_SECONDS, REQUEST_SECONDS)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, _modality.get(), stage)
+    timings = _stage_timings.get()
+    if timings is not None:
+        with _stage_timings_lock:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """
+    Times the block as a pipeline stage of the current request:
+
+    with timed("whisper"):
+        ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+class Stopwatch:
+    """Accumulates the time spent producing the items of lazily evaluated iterables."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def iterate(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            yield item
+
+
+@contextmanager
+def track(modality, request_id=None):
+    """
+    Attributes the stages timed inside the block to one request: they're labeled with
+    modality, and summed per stage into one structured log line tagged with request_id.
+    Inside a request that is already tracked it only relabels the request with modality,
+    e.g. once a generic endpoint knows what it was sent.
+    """
+    if _stage_timings.get() is not None:
+        _modality.set(modality)
+        yield
+        return
+
+    tokens = [
+        _request_id.set(request_id or uuid.uuid4().hex),
+        _modality.set(modality),
+        _stage_timings.set({}),
+    ]
+    start = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        _finish(status, time.perf_counter() - start)
+        for var, token in zip((_stage_timings, _modality, _request_id), reversed(tokens)):
+            var.reset(token)
+
+
+def _finish(status, seconds, extra=None):
+    REQUEST_SECONDS.observe(seconds, _modality.get(), status)
+    with _stage_timings_lock:
+        timings = dict(_stage_timings.get() or {})
+    record = {
+        "event": "request",
+        "request_id": _request_id.get(),
+        "modality": _modality.get(),
+        "status": status,
+        "seconds": round(seconds, 6),
+        "stages": {stage: round(value, 6) for stage, value in timings.items()},
+    }
+    record.update(extra or {})
+    logging.info(json.dumps(record))
+    _dump()
+
+
+def _dump():
+    # With METRICS_DIR set, every worker process publishes its histograms there so that
+    # whichever worker answers /metrics can report the whole server
+    metrics_dir = os.getenv("METRICS_DIR")
+    if not metrics_dir:
+        return
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({histogram.name: histogram.snapshot() for histogram in HISTOGRAMS}, f)
+        os.replace(tmp_path, os.path.join(metrics_dir, f"metrics-{os.getpid()}.json"))
+    except OSError as ex:
+        logging.exception(ex, exc_info=True)
+
+
+def _snapshots():
+    metrics_dir = os.getenv("METRICS_DIR")
+    if not metrics_dir:
+        return [{histogram.name: histogram.snapshot() for histogram in HISTOGRAMS}]
+
+    _dump()
+    snapshots = []
+    for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus():
+    """All histograms in the Prometheus text exposition format, summed over worker processes."""
+    snapshots = _snapshots()
+    lines = []
+    for histogram in HISTOGRAMS:
+        merged = {}
+        for snapshot in snapshots:
+            for labels, series in snapshot.get(histogram.name, {}).items():
+                total = merged.setdefault(labels, {"buckets": [0] * len(histogram.buckets), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], series["buckets"])]
+                total["sum"] += series["sum"]
+                total["count"] += series["count"]
+
+        lines.append(f"# HELP {histogram.name} {histogram.documentation}")
+        lines.append(f"# TYPE {histogram.name} histogram")
+        for labels, series in sorted(merged.items()):
+            labelvalues = json.loads(labels)
+            for bound, count in zip(histogram.buckets, series["buckets"]):
+                bucket_labels = _format_labels(histogram.labelnames, labelvalues, [("le", bound)])
+                lines.append(f"{histogram.name}_bucket{bucket_labels} {count}")
+            inf_labels = _format_labels(histogram.labelnames, labelvalues, [("le", "+Inf")])
+            lines.append(f"{histogram.name}_bucket{inf_labels} {series['count']}")
+            plain_labels = _format_labels(histogram.labelnames, labelvalues)
+            lines.append(f"{histogram.name}_sum{plain_labels} {series['sum']}")
+            lines.append(f"{histogram.name}_count{plain_labels} {series['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """
+    Gives every request an id (the X-Request-ID header, or a new one) that is echoed back,
+    times it and logs its per-stage timings as one JSON line, and serves GET /metrics.
+    """
+
+    @app.before_request
+    def _start_request():
+        if request.path == "/metrics":
+            return
+        g.metrics_tokens = [
+            _request_id.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex),
+            _modality.set(request.blueprint or request.endpoint or "unknown"),
+            _stage_timings.set({}),
+        ]
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _finish_request(response):
+        if getattr(g, "metrics_tokens", None) is None:
+            return response
+        response.headers["X-Request-ID"] = _request_id.get()
+        status = "ok" if response.status_code < 400 else str(response.status_code)
+        _finish(status, time.perf_counter() - g.metrics_start, {"path": request.path})
+        return response
+
+    @app.teardown_request
+    def _reset_request(exc):
+        tokens = getattr(g, "metrics_tokens", None)
+        if tokens is None:
+            return
+        for var, token in zip((_stage_timings, _modality, _request_id), reversed(tokens)):
+            var.reset(token)
+        g.metrics_tokens = None
+
+    @app.route("/metrics", methods=["GET"])
+    def prometheus_metrics():
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
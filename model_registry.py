@@ -0,0 +1,217 @@
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+import onnxruntime
+
+from batching import MicroBatcher
+
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), "models/classifier_model.onnx")
+
+NSFW_MODEL_VARIANTS = ("fp32", "int8")
+
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+_model_versions = {}
+
+_model_bytes = {}
+
+
+def variant_model_path(variant="fp32", input_size=None, model_path=DEFAULT_MODEL_PATH):
+    """
+    Where the variant of model_path lives, as written by model_variants.py:
+    classifier_model.onnx, classifier_model.int8.onnx, classifier_model.int8.224.onnx, ...
+    """
+    if variant not in NSFW_MODEL_VARIANTS:
+        raise ValueError(
+            "Invalid model variant {} specified. Supported "
+            "variants are {}".format(variant, ", ".join(NSFW_MODEL_VARIANTS))
+        )
+
+    root, ext = os.path.splitext(model_path)
+    if variant != "fp32":
+        root += f".{variant}"
+    if input_size:
+        root += f".{int(input_size)}"
+    return root + ext
+
+
+def configured_model_path():
+    """
+    The model file selected by NSFW_MODEL_VARIANT ("fp32" by default, or "int8") and
+    NSFW_INPUT_SIZE (unset for the model's own input size, or e.g. 224).
+    """
+    return variant_model_path(os.getenv("NSFW_MODEL_VARIANT", "fp32"), os.getenv("NSFW_INPUT_SIZE") or None)
+
+
+def session_options_from_env():
+    """
+    Reads the onnxruntime tunables from the environment.
+    ORT_INTRA_OP_THREADS / ORT_INTER_OP_THREADS: 0 lets onnxruntime decide.
+    ORT_GRAPH_OPTIMIZATION_LEVEL: one of "disable", "basic", "extended", "all".
+    """
+    return {
+        "intra_op_threads": int(os.getenv("ORT_INTRA_OP_THREADS", 0)),
+        "inter_op_threads": int(os.getenv("ORT_INTER_OP_THREADS", 0)),
+        "graph_optimization_level": os.getenv("ORT_GRAPH_OPTIMIZATION_LEVEL", "all"),
+    }
+
+
+class ModelSession:
+    """
+    A loaded onnxruntime.InferenceSession with its input/output names cached.
+    InferenceSession.run is thread-safe, so one instance is shared by every request.
+    """
+
+    def __init__(self, model_path, intra_op_threads=0, inter_op_threads=0, graph_optimization_level="all"):
+        if graph_optimization_level not in _GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                "Invalid graph optimization level {} specified. Supported "
+                "levels are {}".format(graph_optimization_level, ", ".join(_GRAPH_OPTIMIZATION_LEVELS.keys()))
+            )
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+
+        self.model_path = model_path
+        model = _model_bytes.get(os.path.abspath(model_path), model_path)
+        self.session = onnxruntime.InferenceSession(model, sess_options=options)
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_shape = self.session.get_inputs()[0].shape
+        self.output_name = self.session.get_outputs()[0].name
+
+    @property
+    def image_size(self):
+        """(height, width) the model expects, or None if its spatial dims are dynamic."""
+        height, width = self.input_shape[1:3]
+        if isinstance(height, int) and isinstance(width, int):
+            return height, width
+        return None
+
+    def run(self, batch):
+        return self.session.run([self.output_name], {self.input_name: batch})[0]
+
+
+def get_session(model_path=None, **options):
+    """
+    Returns the process-wide ModelSession for model_path, loading it on first use.
+    model_path defaults to the configured variant, see configured_model_path.
+    Keyword options override the ORT_* environment tunables.
+    """
+    model_path = model_path or configured_model_path()
+    session_options = session_options_from_env()
+    session_options.update(options)
+    key = (os.path.abspath(model_path), tuple(sorted(session_options.items())))
+
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            logging.info(f"Loading ONNX model {model_path} with {session_options}")
+            session = ModelSession(model_path, **session_options)
+            _sessions[key] = session
+
+    return session
+
+
+def model_version(model_path=None):
+    """Short content hash of the model file, computed once per process."""
+    model_path = os.path.abspath(model_path or configured_model_path())
+    version = _model_versions.get(model_path)
+    if version is None:
+        digest = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        version = digest.hexdigest()[:16]
+        _model_versions[model_path] = version
+    return version
+
+
+def get_batcher(session):
+    """
+    Returns the MicroBatcher that merges concurrent requests for session into shared
+    session.run calls. NSFW_BATCH_MAX_SIZE caps the rows per run (default 16) and
+    NSFW_BATCH_MAX_WAIT_MS is how long a batch waits for more rows (default 5).
+    """
+    batcher = _batchers.get(session)
+    if batcher is not None:
+        return batcher
+
+    with _batchers_lock:
+        batcher = _batchers.get(session)
+        if batcher is None:
+            batcher = MicroBatcher(
+                lambda images: session.run(np.stack(images)),
+                max_batch_size=int(os.getenv("NSFW_BATCH_MAX_SIZE", 16)),
+                max_wait=float(os.getenv("NSFW_BATCH_MAX_WAIT_MS", 5)) / 1000,
+                name=f"batcher-{os.path.basename(session.model_path)}",
+            )
+            _batchers[session] = batcher
+
+    return batcher
+
+
+def predict(session, images, batch_size=4):
+    """
+    Runs session over an (N, H, W, 3) array of preprocessed images and returns the (N, C) scores.
+    With NSFW_MICRO_BATCHING on (default) the images go through the shared batcher and may be
+    run together with other requests' images; otherwise they run alone in batch_size slices.
+    """
+    if not len(images):
+        return np.zeros((0, 0), dtype=np.float32)
+
+    if os.getenv("NSFW_MICRO_BATCHING", "1") == "1":
+        return np.asarray(get_batcher(session).submit(images).result())
+
+    return np.concatenate([session.run(images[i : i + batch_size]) for i in range(0, len(images), batch_size)])
+
+
+def preload(model_path=None):
+    """
+    Reads the model file into memory without creating a session. Meant to run in a
+    pre-fork server's master: the bytes are shared copy-on-write with every worker,
+    while the onnxruntime thread pools, which don't survive fork(), are only
+    created by get_session() inside each worker.
+    """
+    model_path = model_path or configured_model_path()
+    with open(model_path, "rb") as f:
+        _model_bytes[os.path.abspath(model_path)] = f.read()
+
+
+def reset_after_fork():
+    """Drops sessions and batcher threads inherited from the parent process."""
+    with _sessions_lock:
+        _sessions.clear()
+    with _batchers_lock:
+        _batchers.clear()
+
+
+def warmup(model_path=None, image_size=None):
+    """
+    Loads the session and runs one dummy batch so the first real request
+    doesn't pay for session creation and onnxruntime's lazy initialisation.
+    """
+    session = get_session(model_path)
+    image_size = image_size or session.image_size or (256, 256)
+    session.run(np.zeros((1, image_size[0], image_size[1], 3), dtype=np.float32))
+    return session
@@ -0,0 +1,206 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from model_registry import DEFAULT_MODEL_PATH, NSFW_MODEL_VARIANTS, ModelSession, variant_model_path
+from moderation_engine import CATEGORIES
+from preprocessing import load_images
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def quantize_model(model_path, output_path, per_channel=False):
+    """
+    Writes an INT8 dynamically quantized copy of model_path: weights are stored as int8 and
+    activations are quantized on the fly, so no calibration data is needed.
+    """
+    # onnx is only needed to convert models, not to serve them
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(model_path, output_path, per_channel=per_channel, weight_type=QuantType.QInt8)
+    return output_path
+
+
+def resize_model_input(model_path, output_path, input_size):
+    """
+    Writes a copy of model_path taking input_size x input_size images. Only works for
+    models whose layers don't depend on the spatial size, e.g. that end in global pooling,
+    so the copy is checked with a dummy batch and removed if onnxruntime rejects it.
+    """
+    import onnx
+
+    model = onnx.load(model_path)
+    dims = model.graph.input[0].type.tensor_type.shape.dim
+    if len(dims) != 4:
+        raise ValueError(f"Expected an NHWC image input, {model_path} has {len(dims)} input dims")
+    for dim in dims[1:3]:
+        dim.Clear()
+        dim.dim_value = input_size
+    onnx.save(model, output_path)
+
+    try:
+        ModelSession(output_path).run(np.zeros((1, input_size, input_size, 3), dtype=np.float32))
+    except Exception as ex:
+        os.remove(output_path)
+        raise ValueError(f"{model_path} doesn't support {input_size}x{input_size} inputs: {ex}")
+    return output_path
+
+
+def build_variant(variant, input_size=None, model_path=DEFAULT_MODEL_PATH, per_channel=False):
+    """Writes the variant next to model_path, where NSFW_MODEL_VARIANT / NSFW_INPUT_SIZE look for it."""
+    output_path = variant_model_path(variant, input_size, model_path)
+    source_path = model_path
+    if input_size:
+        source_path = resize_model_input(model_path, variant_model_path("fp32", input_size, model_path), input_size)
+    if variant == "int8":
+        quantize_model(source_path, output_path, per_channel=per_channel)
+
+    logging.info(f"Wrote {variant} variant of {model_path} to {output_path}")
+    return output_path
+
+
+def load_labeled_samples(sample_dir, categories=CATEGORIES):
+    """
+    Reads a labeled sample set laid out as one sub-directory per category:
+        sample_dir/unsafe/*.jpg, sample_dir/safe/*.jpg
+    Returns the image paths and their label indices into categories.
+    """
+    image_paths = []
+    labels = []
+    for label, category in enumerate(categories):
+        category_dir = os.path.join(sample_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for file_name in sorted(os.listdir(category_dir)):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                image_paths.append(os.path.join(category_dir, file_name))
+                labels.append(label)
+
+    if not image_paths:
+        raise ValueError(f"No images found in {', '.join(categories)} sub-directories of {sample_dir}")
+    return image_paths, np.asarray(labels)
+
+
+def evaluate_variant(model_path, image_paths, labels, batch_size=16, repeats=3):
+    """
+    Scores the labeled images with one model file. Preprocessing is done up front so the
+    timings only cover session.run; the best of repeats passes is kept.
+    """
+    load_start = time.perf_counter()
+    session = ModelSession(model_path)
+    load_seconds = time.perf_counter() - load_start
+
+    image_size = session.image_size or (256, 256)
+    images, loaded_paths = load_images(image_paths, image_size, image_names=list(range(len(image_paths))))
+    labels = labels[loaded_paths]
+
+    # One untimed pass for onnxruntime's lazy initialisation
+    session.run(images[:batch_size])
+
+    best_seconds = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scores = np.concatenate([session.run(images[i : i + batch_size]) for i in range(0, len(images), batch_size)])
+        seconds = time.perf_counter() - start
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+
+    return {
+        "model_path": model_path,
+        "model_bytes": os.path.getsize(model_path),
+        "input_size": list(image_size),
+        "load_seconds": load_seconds,
+        "images": len(images),
+        "accuracy": float((scores.argmax(axis=1) == labels).mean()),
+        "images_per_second": len(images) / best_seconds,
+        "ms_per_image": 1000 * best_seconds / len(images),
+    }, scores
+
+
+def compare_variants(sample_dir, variants, model_path=DEFAULT_MODEL_PATH, batch_size=16, repeats=3):
+    """
+    Accuracy-versus-speed report of model variants on a labeled sample set, see load_labeled_samples.
+    The first variant is the baseline the others' agreement and score drift are measured against.
+
+    inputs:
+        variants: list of (variant, input_size) pairs, e.g. [("fp32", None), ("int8", None), ("int8", 224)]
+    outputs:
+        list of one report dict per variant
+    """
+    image_paths, labels = load_labeled_samples(sample_dir)
+
+    reports = []
+    baseline_scores = None
+    for variant, input_size in variants:
+        path = variant_model_path(variant, input_size, model_path)
+        if not os.path.exists(path):
+            raise ValueError(f"{path} doesn't exist, build it with: python model_variants.py build --variant {variant}")
+
+        report, scores = evaluate_variant(path, image_paths, labels, batch_size=batch_size, repeats=repeats)
+        report.update(variant=variant, input_size_override=input_size)
+        if baseline_scores is None:
+            baseline_scores = scores
+            baseline = report
+        elif len(scores) == len(baseline_scores):
+            unsafe = CATEGORIES.index("unsafe")
+            unsafe_drift = np.abs(scores[:, unsafe] - baseline_scores[:, unsafe])
+            report.update(
+                agreement=float((scores.argmax(axis=1) == baseline_scores.argmax(axis=1)).mean()),
+                unsafe_score_drift_mean=float(unsafe_drift.mean()),
+                unsafe_score_drift_max=float(unsafe_drift.max()),
+                speedup=report["images_per_second"] / baseline["images_per_second"],
+            )
+        reports.append(report)
+
+    return reports
+
+
+def _parse_variant(value):
+    variant, _, input_size = value.partition(":")
+    return variant, int(input_size) if input_size else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and compare variants of the NSFW classifier")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="the fp32 model the variants derive from")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="write a variant next to the model")
+    build.add_argument("--variant", choices=NSFW_MODEL_VARIANTS, default="int8")
+    build.add_argument("--input-size", type=int, default=None, help="e.g. 224, only for size-agnostic models")
+    build.add_argument("--per-channel", action="store_true", help="quantize weights per output channel")
+
+    report = commands.add_parser("report", help="accuracy vs speed on a labeled sample directory")
+    report.add_argument("sample_dir", help="directory with unsafe/ and safe/ sub-directories")
+    report.add_argument(
+        "--variant",
+        dest="variants",
+        action="append",
+        type=_parse_variant,
+        help="variant[:input_size], repeatable, the first one is the baseline (default: fp32 and int8)",
+    )
+    report.add_argument("--batch-size", type=int, default=16)
+    report.add_argument("--repeats", type=int, default=3)
+    report.add_argument("--output", help="also write the report to this JSON file")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "build":
+        print(build_variant(args.variant, args.input_size, args.model, per_channel=args.per_channel))
+    else:
+        reports = compare_variants(
+            args.sample_dir,
+            args.variants or [("fp32", None), ("int8", None)],
+            model_path=args.model,
+            batch_size=args.batch_size,
+            repeats=args.repeats,
+        )
+        print(json.dumps(reports, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(reports, f, indent=2)
@@ -0,0 +1,358 @@
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+from PIL import Image as pil_image
+from PIL import ImageSequence
+
+from frame_dedup import FrameDeduplicator
+from hash_index import get_hash_index
+from metrics import Stopwatch, observe_stage, timed
+from model_registry import get_session, predict
+from preprocessing import load_images
+
+
+CATEGORIES = ["unsafe", "safe"]
+
+
+# Decode stages: source -> iterable of (name, item), item being an image path,
+# an in-memory stream or a decoded BGR frame
+
+
+def decode_images(image_paths, image_names=None):
+    """
+    Decodes image paths (or streams, or a single one) to PIL images, paired with the names
+    to key their results by. Images that can't be read are logged and left out.
+    """
+    if not isinstance(image_paths, list):
+        image_paths = [image_paths]
+    if image_names is None:
+        image_names = image_paths
+    elif not isinstance(image_names, list):
+        image_names = [image_names]
+
+    for image_name, image_path in zip(image_names, image_paths):
+        try:
+            image = pil_image.open(image_path)
+            image.load()
+        except Exception as ex:
+            logging.exception(f"Error reading {image_path} {ex}", exc_info=True)
+            continue
+        yield image_name, image
+
+
+def decode_video_frames(demuxer, skip_n_frames=0.5, sampling_strategy="interval", sampling_n_frames=None):
+    """
+    Yields (frame_i, frame) for the frames of a VideoDemuxer picked by the sampling strategy,
+    frame_i being 1-based. SKIP_N_FRAMES, FRAME_SAMPLING_STRATEGY and FRAME_SAMPLING_N_FRAMES
+    override the arguments:
+        interval: one frame every skip_n_frames (seconds if < 1, else frames)
+        fixed: sampling_n_frames frames spread over the whole video
+        fps: sampling_n_frames frames per second
+        keyframes: keyframes only, capped at sampling_n_frames if set
+    """
+    skip_n_frames = float(os.getenv("SKIP_N_FRAMES", skip_n_frames))
+    sampling_strategy = os.getenv("FRAME_SAMPLING_STRATEGY", sampling_strategy)
+    sampling_n_frames = os.getenv("FRAME_SAMPLING_N_FRAMES", sampling_n_frames)
+    if sampling_n_frames is not None:
+        sampling_n_frames = float(sampling_n_frames)
+        if sampling_strategy != "fps":
+            sampling_n_frames = int(sampling_n_frames)
+
+    if skip_n_frames < 1:
+        skip_n_frames = int(skip_n_frames * demuxer.fps)
+        logging.info(f"skip_n_frames: {skip_n_frames}")
+
+    for frame_i, frame in demuxer.frames(skip_n_frames, strategy=sampling_strategy, n_frames=sampling_n_frames):
+        yield frame_i + 1, frame
+
+
+# How the decode stages show up in the stage timings
+DECODE_STAGES = {decode_images: "load", decode_video_frames: "sample"}
+
+
+# Dedupe stages: iterable of (name, item) -> the items worth classifying
+
+
+def dedupe_frames(frame_similarity_threshold=None, context_n_frames=3):
+    """
+    Returns a dedupe stage dropping frames that are near-duplicates of one of the last
+    context_n_frames kept ones, by the FrameDeduplicator metric (FRAME_DEDUP_METRIC).
+    """
+
+    def _dedupe(frames):
+        dedup = FrameDeduplicator(thresh=frame_similarity_threshold, context_n_frames=context_n_frames)
+        for frame_i, frame in frames:
+            if not dedup.add(frame):
+                logging.debug(f"{frame_i} is similar to one of the last {context_n_frames} important frames")
+                continue
+
+            logging.debug(f"{frame_i} is added to important frames")
+            yield frame_i, frame
+
+    return _dedupe
+
+
+# Animated images (GIF, WebP, APNG) are classified on their sampled frames
+
+
+def is_animated(item):
+    return isinstance(item, pil_image.Image) and getattr(item, "is_animated", False)
+
+
+def sample_animation_frames(image, skip_n_frames=0.5, max_frames=None, frame_similarity_threshold=None, context_n_frames=3):
+    """
+    Samples an animated image like decode_video_frames and dedupe_frames sample a video: one frame
+    every skip_n_frames (seconds if < 1, else frames, SKIP_N_FRAMES overrides), near-duplicates
+    dropped. Frames are decoded one at a time and only the sampled ones are converted.
+    At most max_frames (ANIMATED_MAX_FRAMES, default 16) are kept: past that, every other kept
+    frame is dropped and the interval doubled, so the samples still span the whole animation.
+    outputs:
+        list of (frame_i, BGR frame), frame_i being 1-based
+    """
+    skip_n_frames = float(os.getenv("SKIP_N_FRAMES", skip_n_frames))
+    max_frames = int(os.getenv("ANIMATED_MAX_FRAMES", max_frames or 16))
+    by_time = skip_n_frames < 1
+    interval = skip_n_frames * 1000 if by_time else int(skip_n_frames)
+
+    dedup = FrameDeduplicator(thresh=frame_similarity_threshold, context_n_frames=context_n_frames)
+    sampled = []
+    next_sample = 0
+    position_ms = 0
+    for frame_i, frame in enumerate(ImageSequence.Iterator(image)):
+        at = position_ms if by_time else frame_i
+        # Browsers play frames without a duration at 10 fps
+        position_ms += frame.info.get("duration") or 100
+        if at < next_sample:
+            continue
+        while next_sample <= at:
+            next_sample += interval
+
+        bgr = cv2.cvtColor(np.asarray(frame.convert("RGB")), cv2.COLOR_RGB2BGR)
+        if not dedup.add(bgr):
+            continue
+        sampled.append((frame_i + 1, bgr))
+        if len(sampled) > max_frames:
+            sampled = sampled[::2]
+            interval *= 2
+
+    image.seek(0)
+    return sampled
+
+
+def expand_animations(items):
+    """
+    Replaces every animated image among items by its sampled frames.
+    outputs:
+        frames: the items, animated ones replaced by their frames
+        owners: for every frame, the position in items it comes from
+        animated: positions of the items that were expanded
+    """
+    frames = []
+    owners = []
+    animated = set()
+    seconds = 0.0
+    for i, item in enumerate(items):
+        if not is_animated(item):
+            frames.append(item)
+            owners.append(i)
+            continue
+
+        animated.add(i)
+        start = time.perf_counter()
+        sampled = sample_animation_frames(item)
+        seconds += time.perf_counter() - start
+        frames.extend(frame for _, frame in sampled)
+        owners.extend([i] * len(sampled))
+
+    if animated:
+        observe_stage("animation", seconds)
+    return frames, owners, animated
+
+
+def most_unsafe_frame(scores, categories):
+    """
+    One row for the (N, C) scores of an animation's frames: the class probabilities of its
+    frame with the highest unsafe probability. An animated image's scores mean the same as a
+    still image's, and a single explicit frame is enough to make the image unsafe.
+    """
+    return scores[scores[:, list(categories).index("unsafe")].argmax()]
+
+
+# Aggregate stages: (names, (N, C) scores, categories) -> result
+
+
+def label_predictions(scores, categories):
+    """
+    Maps the (N, C) scores of predict() to one {category: score} dict per row, in bulk.
+    Categories are ordered from least to most likely within each dict.
+    """
+    order = np.argsort(scores, axis=1)
+    labels = np.asarray(categories)[order].tolist()
+    sorted_scores = np.take_along_axis(scores, order, axis=1).tolist()
+    return [dict(zip(row_labels, row_scores)) for row_labels, row_scores in zip(labels, sorted_scores)]
+
+
+def aggregate_images(names, scores, categories):
+    """
+    {image name: {category: probability}}, images without a string name are keyed by position.
+    For an animated image the probabilities are those of its most unsafe sampled frame.
+    """
+    return {
+        name if isinstance(name, str) else i: image_preds
+        for i, (name, image_preds) in enumerate(zip(names, label_predictions(scores, categories)))
+    }
+
+
+def aggregate_frames(names, scores, categories):
+    """{frame_i: {category: score}}"""
+    return dict(zip(names, label_predictions(scores, categories)))
+
+
+def aggregate_compact(names, scores, categories):
+    """The raw (N, C) scores with their row names and column categories."""
+    return {"names": names, "categories": list(categories), "scores": scores}
+
+
+def aggregate_unsafe_ratio(names, scores, categories, unsafe_thresh=0.5):
+    """Share of the items whose unsafe score is above unsafe_thresh."""
+    unsafe_scores = scores[:, list(categories).index("unsafe")]
+    return float((unsafe_scores > unsafe_thresh).mean())
+
+
+class ModerationEngine:
+    """
+    The one classification pipeline behind image, video and bulk moderation:
+
+        decode -> dedupe -> preprocess -> infer -> aggregate
+
+    Every stage is a plain callable and can be swapped:
+        decode(source, **decode_options): iterable of (name, item)
+        dedupe(pairs): the pairs worth classifying, or None to keep them all
+        preprocess(items, image_size, image_names): (batch, names of the items that loaded)
+        infer(batch): (N, C) scores, defaults to model_registry.predict on the shared session
+        aggregate(names, scores, categories): the result returned by run()
+    image_size defaults to the input size of the session's model, so a variant with a
+    smaller input (NSFW_INPUT_SIZE) gets its frames resized to match.
+    Animated images are expanded into their sampled frames (sample_animation_frames), which are
+    classified in one run and folded back into one row per image by most_unsafe_frame, so every
+    image's scores are class probabilities, animated or not.
+    Before preprocessing, decoded images and frames are looked up in index, the perceptual-hash
+    index at HASH_INDEX_PATH by default: near-duplicates of media moderators already ruled on
+    get the stored verdict as their scores and never reach the model. Pass index=False to skip it.
+
+    engine = ModerationEngine(decode=decode_video_frames, dedupe=dedupe_frames(), aggregate=aggregate_frames)
+    preds = engine.run(demuxer)
+    """
+
+    def __init__(
+        self,
+        decode=decode_images,
+        dedupe=None,
+        preprocess=load_images,
+        infer=None,
+        aggregate=aggregate_images,
+        image_size=None,
+        batch_size=4,
+        categories=CATEGORIES,
+        session=None,
+        index=None,
+    ):
+        self.decode = decode
+        self.dedupe = dedupe
+        self.preprocess = preprocess
+        self.aggregate = aggregate
+        self.batch_size = batch_size
+        self.categories = categories
+        self.session = session if session is not None else get_session()
+        self.image_size = image_size or self.session.image_size or (256, 256)
+        self.infer = infer if infer is not None else self._predict
+        self.index = index if index is not None else get_hash_index()
+
+    def _predict(self, batch):
+        return predict(self.session, batch, batch_size=self.batch_size)
+
+    def iter_scores(self, source, chunk_size=None, **decode_options):
+        """
+        Yields (names, scores) for every chunk of chunk_size decoded items, so only the
+        scores are kept while a long source streams through. Without chunk_size
+        everything is preprocessed and inferred in one go.
+        """
+        decode_watch = Stopwatch()
+        pairs = decode_watch.iterate(self.decode(source, **decode_options))
+        if self.dedupe is not None:
+            dedupe_watch = Stopwatch()
+            pairs = dedupe_watch.iterate(self.dedupe(pairs))
+
+        names, items = [], []
+        for name, item in pairs:
+            names.append(name)
+            items.append(item)
+            if chunk_size and len(items) >= chunk_size:
+                yield self._infer_chunk(names, items)
+                names, items = [], []
+        if items:
+            yield self._infer_chunk(names, items)
+
+        observe_stage(DECODE_STAGES.get(self.decode, "decode"), decode_watch.seconds)
+        if self.dedupe is not None:
+            # The dedupe stage pulls from decode, so its own time is what's left
+            observe_stage("dedup", dedupe_watch.seconds - decode_watch.seconds)
+
+    def _infer_chunk(self, names, items):
+        frames, owners, animated = expand_animations(items)
+        known = {}
+        if self.index:
+            with timed("hash_lookup"):
+                known = self.index.known_scores(frames, self.categories)
+        if not known and not animated:
+            return self._classify(names, items)
+
+        # Only the frames without a stored verdict go through the model
+        unknown = [i for i in range(len(frames)) if i not in known]
+        loaded, scores = self._classify(unknown, [frames[i] for i in unknown], single_run=bool(animated))
+        rows = dict(known)
+        rows.update(zip(loaded, scores))
+
+        # Back to one row per item, in the input order
+        item_rows = {}
+        for position in sorted(rows):
+            item_rows.setdefault(owners[position], []).append(rows[position])
+        positions = sorted(item_rows)
+        return [names[i] for i in positions], np.stack(
+            [most_unsafe_frame(np.stack(item_rows[i]), self.categories) if i in animated else item_rows[i][0] for i in positions]
+        ).astype(np.float32)
+
+    def _classify(self, names, items, single_run=False):
+        if not items:
+            return [], np.empty((0, len(self.categories)), dtype=np.float32)
+        with timed("preprocess"):
+            batch, loaded_names = self.preprocess(items, self.image_size, image_names=names)
+        if not loaded_names:
+            return [], np.empty((0, len(self.categories)), dtype=np.float32)
+        with timed("infer"):
+            if single_run and self.infer == self._predict:
+                # An animation's frames aren't split into batch_size runs (the micro-batcher still
+                # caps a run at NSFW_BATCH_MAX_SIZE, as many as ANIMATED_MAX_FRAMES by default)
+                return loaded_names, predict(self.session, batch, batch_size=len(batch))
+            return loaded_names, self.infer(batch)
+
+    def scores(self, source, chunk_size=None, **decode_options):
+        """All the names and their (N, C) scores for source."""
+        names = []
+        scores = []
+        for chunk_names, chunk_scores in self.iter_scores(source, chunk_size, **decode_options):
+            names.extend(chunk_names)
+            scores.append(chunk_scores)
+        if not scores:
+            return names, np.empty((0, len(self.categories)), dtype=np.float32)
+        return names, np.concatenate(scores)
+
+    def run(self, source, chunk_size=None, **decode_options):
+        """Runs every stage on source. Returns {} when nothing could be classified."""
+        names, scores = self.scores(source, chunk_size, **decode_options)
+        if not names:
+            return {}
+        return self.aggregate(names, scores, self.categories)
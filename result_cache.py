@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from hash_index import get_hash_index
+from model_registry import model_version
+
+
+TEXT_MODERATION_MODEL = "text-moderation-latest"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class MemoryCache:
+    """In-process LRU cache whose entries expire ttl seconds after they were set (0 = never)."""
+
+    def __init__(self, max_entries=10000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return json.loads(value)
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._entries[key] = (expires_at, json.dumps(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskCache:
+    """
+    One JSON file per key under cache_dir, shared by every worker process on the host.
+    Entries expire ttl seconds after they were written (0 = never).
+    """
+
+    def __init__(self, cache_dir, ttl=0):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+
+def get_cache():
+    """
+    Returns the process-wide result cache picked by RESULT_CACHE_BACKEND:
+    "memory" (default), "disk" or "none". RESULT_CACHE_TTL (seconds), RESULT_CACHE_MAX_ENTRIES
+    and RESULT_CACHE_DIR tune the backends.
+    """
+    global _cache
+    if _cache is not None:
+        return _cache
+
+    with _cache_lock:
+        if _cache is None:
+            backend = os.getenv("RESULT_CACHE_BACKEND", "memory")
+            ttl = float(os.getenv("RESULT_CACHE_TTL", 0))
+            if backend == "memory":
+                _cache = MemoryCache(max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000)), ttl=ttl)
+            elif backend == "disk":
+                _cache = DiskCache(os.getenv("RESULT_CACHE_DIR", "./result_cache"), ttl=ttl)
+            elif backend == "none":
+                _cache = False
+            else:
+                raise ValueError(f"Invalid result cache backend {backend} specified. Supported backends are memory, disk, none")
+
+    return _cache
+
+
+def _settings(prefixes):
+    return ",".join(f"{name}={value}" for name, value in sorted(os.environ.items()) if name.startswith(prefixes))
+
+
+def model_versions(modality):
+    """
+    The models and settings a modality's result depends on, so changing one invalidates its
+    entries: the hash index version for images and video frames, the VAD and windowing
+    settings for audio, and the frame sampling and visual check settings for video.
+    """
+    text = TEXT_MODERATION_MODEL
+    whisper = f"{os.getenv('WHISPER_MODEL', 'base')}:{os.getenv('TRANSLATION_BACKEND', 'whisper')}"
+    if modality == "text":
+        return [text]
+    hash_index = get_hash_index()
+    # Frames matching the index take its verdict instead of the model's
+    nsfw = f"{model_version()}:{os.getenv('IMAGE_RESIZE_MODE', 'exact')}:index:{hash_index.version if hash_index else None}"
+    if hash_index is not None:
+        nsfw += f":{os.getenv('HASH_INDEX_MAX_DISTANCE', 6)}"
+    if modality == "image":
+        # Animated images are scored by their most unsafe of up to ANIMATED_MAX_FRAMES frames
+        return [nsfw, f"frames:{os.getenv('ANIMATED_MAX_FRAMES', 16)}:most_unsafe"]
+    audio = _settings(("VAD_", "LONG_MEDIA_MODE", "LONG_MEDIA_WINDOW_SECONDS", "LONG_MEDIA_OVERLAP_SECONDS"))
+    if modality == "audio":
+        return [whisper, text, audio]
+    return [nsfw, whisper, text, audio, _settings(("SKIP_N_FRAMES", "FRAME_", "VISUAL_"))]
+
+
+def hash_text(text):
+    text = " ".join(unicodedata.normalize("NFKC", text).split())
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(modality, content_hash):
+    key = "\0".join([modality, *model_versions(modality), content_hash])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _count(modality, outcome):
+    with _stats_lock:
+        counts = _stats.setdefault(modality, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+
+def cache_stats():
+    """Hit and miss counters per modality since the process started."""
+    with _stats_lock:
+        return {modality: dict(counts) for modality, counts in _stats.items()}
+
+
+def _is_partial(result):
+    # A branch that failed or timed out isn't a verdict worth remembering
+    return isinstance(result, dict) and any(str(key).endswith("-error") for key in result)
+
+
+def lookup(modality, content_hash):
+    """Returns the cached result for content_hash, or None on a miss."""
+    cache = get_cache()
+    if not cache:
+        return None
+
+    try:
+        result = cache.get(cache_key(modality, content_hash))
+    except Exception as ex:
+        logging.exception(ex, exc_info=True)
+        result = None
+
+    _count(modality, "misses" if result is None else "hits")
+    return result
+
+
+def store(modality, content_hash, result):
+    cache = get_cache()
+    if not cache or _is_partial(result):
+        return
+
+    try:
+        cache.set(cache_key(modality, content_hash), result)
+    except Exception as ex:
+        logging.exception(ex, exc_info=True)
+
+
+def cached(modality, content_hash, compute):
+    """
+    Returns the cached result for content_hash, or runs compute() and caches it.
+    A hit skips the whole pipeline: ONNX, Whisper, translation and the OpenAI call.
+    """
+    result = lookup(modality, content_hash)
+    if result is not None:
+        return result
+
+    result = compute()
+    store(modality, content_hash, result)
+    return result
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import openai
+import pytest
+
+import text_model
+
+
+def _moderate_concurrently(texts):
+    """Calls predict_text_mod on every text from its own thread, all at once."""
+    barrier = threading.Barrier(len(texts))
+    outcomes = [None] * len(texts)
+
+    def _call(i):
+        barrier.wait()
+        try:
+            outcomes[i] = text_model.predict_text_mod(texts[i])
+        except Exception as ex:
+            outcomes[i] = ex
+
+    threads = [threading.Thread(target=_call, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not any(thread.is_alive() for thread in threads), "a caller is still waiting"
+    return outcomes
+
+
+class FakeModeration:
+    """Stands in for create_moderation, each result's violence score being its text's number / 1000."""
+
+    def __init__(self):
+        self.calls = []
+        self.hang = False
+
+    def __call__(self, texts, model_name, request_timeout=None):
+        if self.hang:
+            # What the client does once the request timeout is up
+            time.sleep(request_timeout)
+            raise openai.error.Timeout("Request timed out")
+        self.calls.append(len(texts))
+        return {
+            "results": [
+                {
+                    "flagged": False,
+                    "categories": {"violence": False},
+                    "category_scores": {"violence": int(text.split()[-1]) / 1000},
+                }
+                for text in texts
+            ]
+        }
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeModeration()
+    monkeypatch.setattr(text_model, "create_moderation", fake)
+    monkeypatch.setenv("TEXT_MODERATION_COALESCING", "1")
+    monkeypatch.setenv("TEXT_MODERATION_TIMEOUT", "0.2")
+    return fake
+
+
+def test_concurrent_calls_are_merged_and_get_their_own_result(upstream):
+    texts = [f"text {i}" for i in range(64)]
+
+    outcomes = _moderate_concurrently(texts)
+
+    for i, outcome in enumerate(outcomes):
+        assert outcome["category_scores"]["violence"] == f"{i / 1000:.15f}"
+    assert sum(upstream.calls) == len(texts)
+    assert len(upstream.calls) < len(texts)
+    assert max(upstream.calls) <= text_model.get_coalescer().max_batch_size
+
+
+def test_timed_out_call_releases_its_callers(upstream):
+    upstream.hang = True
+    start = time.perf_counter()
+
+    outcomes = _moderate_concurrently([f"text {i}" for i in range(8)])
+
+    assert all(isinstance(outcome, openai.error.Timeout) for outcome in outcomes)
+    assert time.perf_counter() - start < 5
+
+
+def test_calls_after_a_timeout_succeed(upstream):
+    upstream.hang = True
+    with pytest.raises(openai.error.Timeout):
+        text_model.predict_text_mod("text 1")
+
+    upstream.hang = False
+    assert text_model.predict_text_mod("text 7")["category_scores"]["violence"] == f"{0.007:.15f}"
+
+
+def test_predict_text_mod_many_keeps_the_order_across_chunks(upstream, monkeypatch):
+    monkeypatch.setenv("TEXT_MODERATION_MAX_BATCH", "3")
+    texts = [f"text {i}" for i in range(10)]
+
+    results = text_model.predict_text_mod_many(texts)
+
+    assert [result["category_scores"]["violence"] for result in results] == [f"{i / 1000:.15f}" for i in range(10)]
+    assert upstream.calls == [3, 3, 3, 1]
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from benchmark import AUDIO_SAMPLE_RATE, MUSIC_STYLES, synth_music, synth_speech
+from vad import speech_only, speech_segments
+
+
+SECONDS = 20
+
+
+def _speech_share(samples):
+    segments = speech_segments(samples.astype(np.float32), AUDIO_SAMPLE_RATE)
+    return sum(end - start for start, end in segments) / len(samples)
+
+
+@pytest.fixture(scope="module")
+def speech():
+    return synth_speech(SECONDS, np.random.default_rng(0))
+
+
+@pytest.fixture(scope="module")
+def music():
+    rng = np.random.default_rng(1)
+    return {style: synth_music(style, SECONDS, rng) for style in MUSIC_STYLES}
+
+
+def test_speech_is_kept(speech):
+    assert _speech_share(speech) >= 0.8
+
+
+def test_speech_in_noise_is_kept(speech):
+    noise = 0.03 * np.random.default_rng(2).standard_normal(len(speech))
+    assert _speech_share(speech + noise) >= 0.8
+
+
+@pytest.mark.parametrize("style", ["pad", "beat"])
+def test_speech_over_music_is_kept(speech, music, style):
+    # The music bed 12 dB below the voice
+    assert _speech_share(speech + 0.25 * music[style]) >= 0.8
+
+
+@pytest.mark.parametrize("style", MUSIC_STYLES)
+def test_instrumental_music_is_dropped(music, style):
+    assert _speech_share(music[style]) <= 0.05
+
+
+def test_speech_only_skips_music_and_silence(music):
+    assert speech_only(music["beat"].astype(np.float32), AUDIO_SAMPLE_RATE) is None
+    assert speech_only(np.zeros(AUDIO_SAMPLE_RATE, dtype=np.float32), AUDIO_SAMPLE_RATE) is None
@@ -1,15 +1,19 @@
 import os
+import threading
+
 import openai
 
+from batching import MicroBatcher
+
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
 
+_coalescers = {}
+_coalescers_lock = threading.Lock()
 
-def predict_text_mod(text, model_name="text-moderation-latest"):
-    response = openai.Moderation.create(input=text, model=model_name)
-    moderation_class = response["results"][0]
 
+def format_moderation_class(moderation_class):
     # Convert category_scores from scientific notation to decimal
     for key, value in moderation_class["category_scores"].items():
         moderation_class["category_scores"][key] = f'{value:.15f}'
@@ -17,6 +21,68 @@ def predict_text_mod(text, model_name="text-moderation-latest"):
     return moderation_class
 
 
+def create_moderation(texts, model_name, request_timeout=None):
+    """
+    openai.Moderation.create with a request_timeout: the openai 0.27 create doesn't take one,
+    so its requests would wait up to the library's 600s default.
+    """
+    instance, params = openai.Moderation._prepare_create(texts, model_name, None)
+    return instance.request("post", openai.Moderation.get_url(), params, request_timeout=request_timeout)
+
+
+def predict_text_mod_many(texts, model_name="text-moderation-latest"):
+    """
+    Moderates a list of texts with as few upstream calls as possible: the moderation
+    endpoint takes a list of inputs, sent in chunks of TEXT_MODERATION_MAX_BATCH (default 32).
+    Results come back in the order of texts. Each call gives up after TEXT_MODERATION_TIMEOUT
+    seconds (default 10) with openai.error.Timeout. The endpoint can be swapped for a local
+    stub by pointing OPENAI_API_BASE at it.
+    """
+    max_batch = int(os.getenv("TEXT_MODERATION_MAX_BATCH", 32))
+    # All texts of a process share one coalescer thread, a hung call mustn't hold them all up
+    timeout = float(os.getenv("TEXT_MODERATION_TIMEOUT", 10))
+    texts = list(texts)
+
+    moderation_classes = []
+    for start in range(0, len(texts), max_batch):
+        response = create_moderation(texts[start : start + max_batch], model_name, request_timeout=timeout)
+        moderation_classes.extend(response["results"])
+
+    return [format_moderation_class(moderation_class) for moderation_class in moderation_classes]
+
+
+def get_coalescer(model_name="text-moderation-latest"):
+    """
+    Returns the MicroBatcher that merges concurrent predict_text_mod calls into one
+    upstream request of up to TEXT_MODERATION_MAX_BATCH texts, waiting at most
+    TEXT_MODERATION_MAX_WAIT_MS (default 10) for more texts to join. A batch whose upstream
+    call fails or times out fails the predict_text_mod calls in it, not the ones after it.
+    """
+    coalescer = _coalescers.get(model_name)
+    if coalescer is not None:
+        return coalescer
+
+    with _coalescers_lock:
+        coalescer = _coalescers.get(model_name)
+        if coalescer is None:
+            coalescer = MicroBatcher(
+                lambda texts: predict_text_mod_many(texts, model_name),
+                max_batch_size=int(os.getenv("TEXT_MODERATION_MAX_BATCH", 32)),
+                max_wait=float(os.getenv("TEXT_MODERATION_MAX_WAIT_MS", 10)) / 1000,
+                name=f"coalescer-{model_name}",
+            )
+            _coalescers[model_name] = coalescer
+
+    return coalescer
+
+
+def predict_text_mod(text, model_name="text-moderation-latest"):
+    if os.getenv("TEXT_MODERATION_COALESCING", "1") == "1":
+        return get_coalescer(model_name).submit([text]).result()[0]
+
+    return predict_text_mod_many([text], model_name)[0]
+
+
 if __name__ == "__main__":
     INPUT_TEXT = input("Enter text: ")
-    predict_text_mod(INPUT_TEXT)
\ No newline at end of file
+    predict_text_mod(INPUT_TEXT)
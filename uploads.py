@@ -0,0 +1,77 @@
+import hashlib
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+
+from flask import Request
+from werkzeug.utils import secure_filename
+
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+class SpooledRequest(Request):
+    """
+    Keeps uploaded files in memory up to UPLOAD_SPOOL_MAX_BYTES (default 10 MB)
+    before spilling them to an anonymous temporary file, instead of werkzeug's fixed 500 KB.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_size = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", 10 * 1024 * 1024))
+        return tempfile.SpooledTemporaryFile(max_size=max_size, mode="rb+")
+
+
+def upload_name(file_storage):
+    return secure_filename(file_storage.filename or "") or "upload"
+
+
+def read_upload(file_storage):
+    """
+    Reads an upload into memory, for images that are decoded straight from the bytes.
+    Returns the in-memory stream and the SHA-256 of its content.
+    """
+    data = file_storage.stream.read()
+    return io.BytesIO(data), hashlib.sha256(data).hexdigest()
+
+
+def save_upload(file_storage, directory=None):
+    """
+    Copies an upload to a new uniquely named file in directory (the system temp dir
+    by default), hashing it on the way. Returns the file's path and SHA-256.
+    """
+    suffix = os.path.splitext(upload_name(file_storage))[1]
+    digest = hashlib.sha256()
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="upload-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: file_storage.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, digest.hexdigest()
+
+
+@contextmanager
+def upload_tempfile(file_storage):
+    """
+    Copies an upload to a uniquely named temporary file for decoders that need a path
+    (ffmpeg, OpenCV), hashing it on the way, and deletes the file on exit.
+    Concurrent uploads with the same client filename never share a path.
+    UPLOAD_TMP_DIR picks the directory, defaulting to the system temp dir.
+
+    with upload_tempfile(request.files["video"]) as (video_path, video_hash):
+        ...
+    """
+    path, content_hash = save_upload(file_storage, os.getenv("UPLOAD_TMP_DIR"))
+    try:
+        yield path, content_hash
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
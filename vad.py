@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+
+
+VAD_MODES = ("trim", "skip", "off")
+
+# Sub-bands of the speech band whose energy is checked for syllable-rate modulation. The most
+# modulated one counts, so a voice over a music bed that dominates the other bands is still found
+MODULATION_BANDS = ((250, 500), (500, 1000), (1000, 2000), (2000, 4000))
+
+
+def syllabic_modulation(power, freqs, frame_ms, window_ms=1000):
+    """
+    Per frame, how strongly (dB RMS over the surrounding window_ms) the energy of the most
+    modulated speech sub-band swings at syllable rate, 2-8 Hz. Talking comes and goes a few
+    times a second and scores well above 10 dB, sustained or evenly struck music a few dB.
+    """
+    n_frames = len(power)
+    modulation_freqs = np.fft.rfftfreq(n_frames, frame_ms / 1000)
+    syllable_rate = (modulation_freqs >= 2) & (modulation_freqs <= 8)
+    window = np.ones(min(max(int(window_ms / frame_ms), 1), n_frames))
+    window /= len(window)
+
+    modulation = np.zeros(n_frames)
+    for low, high in MODULATION_BANDS:
+        band_db = 10 * np.log10(power[:, (freqs >= low) & (freqs < high)].sum(axis=1) + 1e-10)
+        # Dips below the band's own noise floor are background noise, not articulation
+        band_db = np.maximum(band_db, np.percentile(band_db, 10))
+        spectrum = np.fft.rfft(band_db - band_db.mean())
+        spectrum[~syllable_rate] = 0
+        band_modulation = np.sqrt(np.convolve(np.fft.irfft(spectrum, n_frames) ** 2, window, "same"))
+        modulation = np.maximum(modulation, band_modulation)
+    return modulation
+
+
+def frame_features(audio, sample_rate, frame_ms=30):
+    """
+    Splits audio into non-overlapping frame_ms frames and returns, per frame, its energy
+    in dBFS, the share of that energy in the 250-4000 Hz speech band and its syllabic
+    modulation in dB (see syllabic_modulation).
+    """
+    frame_length = int(sample_rate * frame_ms / 1000)
+    n_frames = len(audio) // frame_length
+    if n_frames == 0:
+        return np.empty(0), np.empty(0), np.empty(0), frame_length
+
+    frames = audio[: n_frames * frame_length].reshape(n_frames, frame_length)
+    energy_db = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+
+    power = np.abs(np.fft.rfft(frames * np.hanning(frame_length), axis=1)) ** 2
+    freqs = np.fft.rfftfreq(frame_length, 1 / sample_rate)
+    speech_band = (freqs >= 250) & (freqs <= 4000)
+    band_ratio = power[:, speech_band].sum(axis=1) / (power.sum(axis=1) + 1e-10)
+
+    return energy_db, band_ratio, syllabic_modulation(power, freqs, frame_ms), frame_length
+
+
+def speech_segments(audio, sample_rate, frame_ms=30):
+    """
+    Cheap energy-based voice activity detection. A frame counts as speech when it is
+    VAD_ENERGY_MARGIN_DB (default 10) above the clip's noise floor (its 10th percentile
+    frame energy) or louder than VAD_LOUD_DB (default -35 dBFS), is louder than
+    VAD_MIN_ENERGY_DB (default -50 dBFS) in any case, and has at least
+    VAD_SPEECH_BAND_RATIO (default 0.3) of its energy in the speech band, which rules out
+    hum and rumble, and a syllabic modulation above VAD_MODULATION_DB (default 6), which
+    rules out instrumental music: it fills the speech band too, but without talking's
+    syllable-rate rise and fall. Speech frames are padded by VAD_PADDING_MS (default 200)
+    on both sides, and segments with less than VAD_MIN_SPEECH_MS (default 250) of speech
+    frames are dropped. Sung lyrics rise and fall like talking, so vocals still count as
+    speech, while a voice mixed barely above its music bed may be missed.
+
+    outputs:
+        list of (start_sample, end_sample) speech segments, empty if there is no speech
+    """
+    energy_db, band_ratio, modulation_db, frame_length = frame_features(audio, sample_rate, frame_ms)
+    if not len(energy_db):
+        return []
+
+    noise_floor = np.percentile(energy_db, 10)
+    # Loud frames count even without quieter ones around, so wall-to-wall speech isn't
+    # mistaken for the noise floor
+    loud_enough = min(noise_floor + float(os.getenv("VAD_ENERGY_MARGIN_DB", 10)), float(os.getenv("VAD_LOUD_DB", -35)))
+    speech = (
+        (energy_db > loud_enough)
+        & (energy_db > float(os.getenv("VAD_MIN_ENERGY_DB", -50)))
+        & (band_ratio > float(os.getenv("VAD_SPEECH_BAND_RATIO", 0.3)))
+        & (modulation_db > float(os.getenv("VAD_MODULATION_DB", 6)))
+    )
+
+    min_speech_frames = max(int(float(os.getenv("VAD_MIN_SPEECH_MS", 250)) / frame_ms), 1)
+    padding_frames = int(float(os.getenv("VAD_PADDING_MS", 200)) / frame_ms)
+
+    # Pad every run of speech frames, which also bridges the short dips between syllables
+    merged = []
+    for start, end in _runs(speech):
+        start, end = max(start - padding_frames, 0), min(end + padding_frames, len(speech))
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    # Then drop segments with too little actual speech in them, e.g. a door slam
+    speech_count = np.concatenate(([0], np.cumsum(speech)))
+    return [
+        (int(start * frame_length), int(min(end * frame_length, len(audio))))
+        for start, end in merged
+        if speech_count[end] - speech_count[start] >= min_speech_frames
+    ]
+
+
+def _runs(mask):
+    """(start, end) index pairs of the runs of True in a boolean array."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+def speech_only(audio, sample_rate, mode=None):
+    """
+    The VAD pre-pass before Whisper, picked by VAD_MODE:
+        trim (default): returns only the speech segments, joined by 100 ms of silence
+        skip: returns the audio untouched if it has any speech
+        off: always returns the audio untouched
+    Returns None when the audio has no speech, so Whisper can be skipped entirely.
+    """
+    mode = mode or os.getenv("VAD_MODE", "trim")
+    if mode not in VAD_MODES:
+        raise ValueError("Invalid VAD mode {} specified. Supported modes are {}".format(mode, ", ".join(VAD_MODES)))
+    if mode == "off":
+        return audio
+
+    segments = speech_segments(audio, sample_rate)
+    if not segments:
+        return None
+    if mode == "skip":
+        return audio
+
+    gap = np.zeros(int(sample_rate * 0.1), dtype=audio.dtype)
+    pieces = []
+    for start, end in segments:
+        if pieces:
+            pieces.append(gap)
+        pieces.append(audio[start:end])
+    return np.concatenate(pieces)
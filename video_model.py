@@ -1,23 +1,227 @@
+import contextvars
+import logging
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
+from audio_model import MAX_DURATION, audio_moderate_windowed
+from media_demux import VideoDemuxer
+from metrics import timed
 from verbal_moderation import check_audio_moderation
-from visual_moderation import check_visual_moderation
+from visual_moderation import (
+    check_visual_moderation,
+    check_visual_moderation_early_exit,
+    check_visual_moderation_windowed,
+)
 
 
 # from old_visual_moderation import check_visual_moderation
 
 
+def _branch_timeout(name):
+    timeout = float(os.getenv(f"{name.upper()}_BRANCH_TIMEOUT", 0))
+    return timeout if timeout > 0 else None
+
+
+def _timed_branch(name, branch):
+    with timed(f"{name}_branch"):
+        return branch()
+
+
+def run_branches(branches, on_all_done=None):
+    """
+    Runs the independent moderation branches in parallel threads.
+    ONNX and Whisper (torch) release the GIL while they compute, so threads overlap
+    them without copying the decoded video into worker processes. Each branch runs in
+    a copy of the caller's context, so its stage timings count towards the request.
+
+    inputs:
+        branches: dict of branch name -> callable
+        on_all_done: called once every branch has finished, including ones that timed out
+    outputs:
+        results: dict of branch name -> return value, for branches that succeeded
+        errors: dict of branch name -> error message, for branches that failed or timed out
+    """
+    executor = ThreadPoolExecutor(max_workers=len(branches), thread_name_prefix="video-branch")
+    futures = {
+        name: executor.submit(contextvars.copy_context().run, _timed_branch, name, branch)
+        for name, branch in branches.items()
+    }
+    # Don't block on branches that overrun their timeout, they finish in the background
+    executor.shutdown(wait=False)
+
+    if on_all_done is not None:
+        pending = [len(futures)]
+        pending_lock = threading.Lock()
+
+        def _branch_done(_future):
+            with pending_lock:
+                pending[0] -= 1
+                all_done = pending[0] == 0
+            if all_done:
+                on_all_done()
+
+        for future in futures.values():
+            future.add_done_callback(_branch_done)
+
+    results = {}
+    errors = {}
+    start = time.monotonic()
+    for name, future in futures.items():
+        timeout = _branch_timeout(name)
+        if timeout is not None:
+            timeout = max(0, start + timeout - time.monotonic())
+        try:
+            results[name] = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logging.error(f"{name} branch timed out after {_branch_timeout(name)}s")
+            errors[name] = "timed out"
+        except Exception as ex:
+            logging.exception(ex, exc_info=True)
+            errors[name] = str(ex)
+
+    return results, errors
+
+
 def video_moderate(video_filepath):
+    """
+    VIDEO_BRANCH_MODE selects how the audio and visual branches run:
+    "concurrent" (default) overlaps them, "sequential" runs one after the other.
+    In concurrent mode AUDIO_BRANCH_TIMEOUT / VISUAL_BRANCH_TIMEOUT (seconds) bound
+    each branch, and a branch that fails or times out is reported as
+    "audio-error" / "video-error" next to the result of the other one.
+    Videos longer than MAX_DURATION are moderated in windows unless LONG_MEDIA_MODE is "reject".
+    """
+    if os.getenv("VIDEO_BRANCH_MODE", "concurrent") == "sequential":
+        return _video_moderate_sequential(video_filepath)
+
+    demuxer = VideoDemuxer(video_filepath)
+    if demuxer.duration > MAX_DURATION:
+        if os.getenv("LONG_MEDIA_MODE", "windowed") == "windowed":
+            return _video_moderate_windowed(video_filepath, demuxer)
+        demuxer.release()
+        return "Please upload video with duration less than 45 seconds."
+
+    demuxer.start_audio()
+    results, errors = run_branches(
+        {
+            "audio": lambda: check_audio_moderation(video_filepath, demuxer),
+            "visual": lambda: _visual_result(video_filepath, demuxer),
+        },
+        on_all_done=demuxer.release,
+    )
+
+    if "visual" in errors:
+        visual_result = {"video-unsafe": None, "video-error": errors["visual"]}
+    else:
+        visual_result = results["visual"]
+
+    if "audio" in errors:
+        video_score = {"audio-available": "unknown", "audio-error": errors["audio"]}
+        video_score.update(visual_result)
+        return video_score
+
+    return _video_score(results["audio"], visual_result)
+
+
+def _video_moderate_windowed(video_filepath, demuxer):
+    """
+    Long videos: both branches stream their windows instead of decoding the whole file,
+    the audio one straight from ffmpeg and the visual one from demuxer's frames.
+    The result carries a "timeline" with the audio and visual verdict of every window.
+    """
+    results, errors = run_branches(
+        {
+            "audio": lambda: audio_moderate_windowed(video_filepath),
+            "visual": lambda: check_visual_moderation_windowed(video_filepath, demuxer),
+        },
+        on_all_done=demuxer.release,
+    )
+
+    visual_timeline = []
+    if "visual" in errors:
+        visual_result = {"video-unsafe": None, "video-error": errors["visual"]}
+    else:
+        visual_result = {"video-unsafe": results["visual"]["unsafe_ratio"]}
+        visual_timeline = results["visual"]["timeline"]
+
+    if "audio" in errors:
+        audio_timeline = []
+        video_score = {"audio-available": "unknown", "audio-error": errors["audio"]}
+        video_score.update(visual_result)
+    else:
+        audio_result = results["audio"]
+        audio_timeline = audio_result.pop("timeline", []) if isinstance(audio_result, dict) else []
+        video_score = _video_score(audio_result, visual_result)
+
+    video_score["timeline"] = _merge_timelines(audio_timeline, visual_timeline)
+    return video_score
+
+
+def _merge_timelines(audio_timeline, visual_timeline):
+    # Both branches cut the same window grid, so windows line up by start time
+    windows = {}
+    for window in visual_timeline + audio_timeline:
+        merged = windows.setdefault(round(window["start"], 3), {"start": window["start"], "end": window["end"]})
+        merged["end"] = max(merged["end"], window["end"])
+        merged.update({key: value for key, value in window.items() if key not in ("start", "end")})
+    return [windows[start] for start in sorted(windows)]
+
+
+def _video_moderate_sequential(video_filepath):
+    with VideoDemuxer(video_filepath) as demuxer:
+        if demuxer.duration > MAX_DURATION:
+            if os.getenv("LONG_MEDIA_MODE", "windowed") == "windowed":
+                audio_result = audio_moderate_windowed(video_filepath)
+                visual_result = check_visual_moderation_windowed(video_filepath, demuxer)
+                audio_timeline = audio_result.pop("timeline", []) if isinstance(audio_result, dict) else []
+                video_score = _video_score(audio_result, {"video-unsafe": visual_result["unsafe_ratio"]})
+                video_score["timeline"] = _merge_timelines(audio_timeline, visual_result["timeline"])
+                return video_score
+            return "Please upload video with duration less than 45 seconds."
+
+        # The audio track decodes in the background while the frames are sampled
+        demuxer.start_audio()
+        visual_result = _visual_result(video_filepath, demuxer)
+        audio_score = check_audio_moderation(video_filepath, demuxer)
+
+    return _video_score(audio_score, visual_result)
+
+
+def _visual_result(video_filepath, demuxer):
+    """
+    VISUAL_EARLY_EXIT=1 stops classifying frames once the verdict is settled, see
+    check_visual_moderation_early_exit, and reports how many frames it examined.
+    """
+    if os.getenv("VISUAL_EARLY_EXIT", "0") == "1":
+        result = check_visual_moderation_early_exit(video_filepath, demuxer)
+        return {
+            "video-unsafe": result["unsafe_ratio"],
+            "video-flagged": result["flagged"],
+            "video-decided-by": result["decided_by"],
+            "video-frames-examined": result["frames_examined"],
+            "video-frames-total": result["frames_total"],
+        }
+
+    return {"video-unsafe": check_visual_moderation(video_filepath, demuxer)}
+
+
+def _video_score(audio_score, visual_result):
     video_score = {}
-    audio_score = check_audio_moderation(video_filepath)
     if audio_score == False:
         return "Please upload video with duration less than 45 seconds."
     elif audio_score == "No audio":
-        visual_unsafe_ratio = check_visual_moderation(video_filepath)
-        video_score = {"audio-available": "false", "video-unsafe": visual_unsafe_ratio}
+        video_score = {"audio-available": "false"}
+        video_score.update(visual_result)
+        return video_score
+    elif isinstance(audio_score, str):
+        # audio_moderate explains why there is nothing to score, e.g. no speech was found
+        video_score = {"audio-available": "true", "audio-result": audio_score}
+        video_score.update(visual_result)
         return video_score
     else:
-        visual_unsafe_ratio = check_visual_moderation(video_filepath)
         video_score = {"audio-available": "true",
                         "audio-sexual": audio_score["category_scores"]["sexual"], 
                         "audio-hate": audio_score["category_scores"]["hate"], 
@@ -29,8 +233,8 @@ def video_moderate(video_filepath):
                         "audio-self-harm/intent": audio_score["category_scores"]["self-harm/intent"], 
                         "audio-self-harm/instructions": audio_score["category_scores"]["self-harm/instructions"], 
                         "audio-harassment/threatening": audio_score["category_scores"]["harassment/threatening"], 
-                        "audio-violence": audio_score["category_scores"]["violence"], 
-                        "video-unsafe": visual_unsafe_ratio}
+                        "audio-violence": audio_score["category_scores"]["violence"]}
+        video_score.update(visual_result)
         return video_score
         
         
@@ -3,11 +3,17 @@ import os
 
 import cv2
 import numpy as np
-import onnxruntime
-import pydload
 from skimage import metrics as skimage_metrics
 
-from image_model import load_images
+from image_model import Classifier as ImageClassifier
+from media_demux import VideoDemuxer
+from moderation_engine import (
+    ModerationEngine,
+    aggregate_compact,
+    aggregate_frames,
+    decode_video_frames,
+    dedupe_frames,
+)
 
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -54,67 +60,84 @@ def is_similar_frame(f1, f2, resize_to=(64, 64), thresh=0.5, return_score=False)
     return False
 
 
+def iter_interest_frames(
+    demuxer,
+    frame_similarity_threshold=None,
+    similarity_context_n_frames=3,
+    skip_n_frames=0.5,
+    sampling_strategy="interval",
+    sampling_n_frames=None,
+):
+    """
+    Yields (frame_i, frame) for the sampled frames of demuxer that aren't near-duplicates:
+    the decode and dedupe stages of the moderation engine. Frames come one at a time,
+    so callers can process a video of any length in bounded memory.
+    frame_i is 1-based.
+
+    sampling_strategy / FRAME_SAMPLING_STRATEGY picks the frames that are decoded:
+        interval: one frame every skip_n_frames (seconds if < 1, else frames)
+        fixed: sampling_n_frames frames spread over the whole video
+        fps: sampling_n_frames frames per second
+        keyframes: keyframes only, capped at sampling_n_frames if set
+    Near-duplicate frames are dropped with a FrameDeduplicator, whose metric is
+    picked by FRAME_DEDUP_METRIC (ssim, phash or mad).
+    """
+    frames = decode_video_frames(demuxer, skip_n_frames, sampling_strategy, sampling_n_frames)
+    return dedupe_frames(frame_similarity_threshold, similarity_context_n_frames)(frames)
+
+
 def get_interest_frames_from_video(
     video_path,
-    frame_similarity_threshold=0.5,
+    frame_similarity_threshold=None,
     similarity_context_n_frames=3,
     skip_n_frames=0.5,
     output_frames_to_dir=None,
+    demuxer=None,
+    sampling_strategy="interval",
+    sampling_n_frames=None,
 ):
-    skip_n_frames = float(os.getenv("SKIP_N_FRAMES", skip_n_frames))
-
+    """Collects the frames of iter_interest_frames, see there for the sampling options."""
     important_frames = []
     fps = 0
     video_length = 0
+    owns_demuxer = demuxer is None
 
     try:
-        video = cv2.VideoCapture(video_path)
-        fps = video.get(cv2.CAP_PROP_FPS)
-        length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        if skip_n_frames < 1:
-            skip_n_frames = int(skip_n_frames * fps)
-            logging.info(f"skip_n_frames: {skip_n_frames}")
-
-        video_length = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        for frame_i in range(length + 1):
-            read_flag, current_frame = video.read()
-
-            if not read_flag:
-                break
-
-            if skip_n_frames > 0:
-                if frame_i % skip_n_frames != 0:
-                    continue
-
-            frame_i += 1
-
-            found_similar = False
-            for context_frame_i, context_frame in reversed(important_frames[-1 * similarity_context_n_frames :]):
-                if is_similar_frame(context_frame, current_frame, thresh=frame_similarity_threshold):
-                    logging.debug(f"{frame_i} is similar to {context_frame_i}")
-                    found_similar = True
-                    break
-
-            if not found_similar:
-                logging.debug(f"{frame_i} is added to important frames")
-                important_frames.append((frame_i, current_frame))
-                if output_frames_to_dir:
-                    if not os.path.exists(output_frames_to_dir):
-                        os.mkdir(output_frames_to_dir)
-
-                    output_frames_to_dir = output_frames_to_dir.rstrip("/")
-                    cv2.imwrite(
-                        f"{output_frames_to_dir}/{str(frame_i).zfill(10)}.png",
-                        current_frame,
-                    )
+        if owns_demuxer:
+            demuxer = VideoDemuxer(video_path)
+        fps = demuxer.fps
+        length = demuxer.frame_count
+        video_length = demuxer.frame_count
+
+        interest_frames = iter_interest_frames(
+            demuxer,
+            frame_similarity_threshold=frame_similarity_threshold,
+            similarity_context_n_frames=similarity_context_n_frames,
+            skip_n_frames=skip_n_frames,
+            sampling_strategy=sampling_strategy,
+            sampling_n_frames=sampling_n_frames,
+        )
+        for frame_i, current_frame in interest_frames:
+            important_frames.append((frame_i, current_frame))
+            if output_frames_to_dir:
+                if not os.path.exists(output_frames_to_dir):
+                    os.mkdir(output_frames_to_dir)
+
+                output_frames_to_dir = output_frames_to_dir.rstrip("/")
+                cv2.imwrite(
+                    f"{output_frames_to_dir}/{str(frame_i).zfill(10)}.png",
+                    current_frame,
+                )
 
         logging.info(f"{len(important_frames)} important frames will be processed from {video_path} of length {length}")
 
     except Exception as ex:
         logging.exception(ex, exc_info=True)
 
+    finally:
+        if owns_demuxer and demuxer is not None:
+            demuxer.release()
+
     return (
         [i[0] for i in important_frames],
         [i[1] for i in important_frames],
@@ -123,154 +146,238 @@ def get_interest_frames_from_video(
     )
 
 
-class Classifier:
+class Classifier(ImageClassifier):
     """
     Class for loading model and running predictions.
     For example on how to use take a look the if __name__ == '__main__' part.
     """
 
-    nsfw_model = None
-
-    def __init__(self):
-        """
-        model = Classifier()
-        """
-        url = "https://github.com/notAI-tech/NudeNet/releases/download/v0/classifier_model.onnx"
-        home = os.path.expanduser("~")
-        model_folder = os.path.join(home, ".NudeNet/")
-        if not os.path.exists(model_folder):
-            os.mkdir(model_folder)
-
-        model_path = os.path.join(model_folder, os.path.basename(url))
-
-        if not os.path.exists(model_path):
-            print("Downloading the checkpoint to", model_path)
-            pydload.dload(url, save_to_path=model_path, max_time=None)
-
-        self.nsfw_model = onnxruntime.InferenceSession("models/classifier_model.onnx")
-
     def classify_video(
         self,
         video_path,
         batch_size=4,
-        image_size=(256, 256),
+        image_size=None,
         categories=["unsafe", "safe"],
+        demuxer=None,
+        compact=False,
     ):
-        frame_indices = None
-        frame_indices, frames, fps, video_length = get_interest_frames_from_video(video_path)
-        logging.debug(
-            f"VIDEO_PATH: {video_path}, FPS: {fps}, Important frame indices: {frame_indices}, Video length: {video_length}"
+        """
+        Classifies the interesting frames of video_path.
+        outputs:
+            {"metadata", "preds": {frame_i: {category: score}}}, or with compact
+            {"metadata", "frame_indices", "categories", "scores"} holding the raw (N, C) scores
+        """
+        engine = ModerationEngine(
+            decode=decode_video_frames,
+            dedupe=dedupe_frames(),
+            aggregate=aggregate_compact if compact else aggregate_frames,
+            image_size=image_size,
+            batch_size=batch_size,
+            categories=categories,
+            session=self.nsfw_model,
         )
 
-        frames, frame_names = load_images(frames, image_size, image_names=frame_indices)
+        owns_demuxer = demuxer is None
+        if owns_demuxer:
+            demuxer = VideoDemuxer(video_path)
+        try:
+            result = engine.run(demuxer)
+        finally:
+            if owns_demuxer:
+                demuxer.release()
 
-        if not frame_names:
+        if not result:
             return {}
 
-        preds = []
-        model_preds = []
-        while len(frames):
-            _model_preds = self.nsfw_model.run(
-                [self.nsfw_model.get_outputs()[0].name],
-                {self.nsfw_model.get_inputs()[0].name: frames[:batch_size]},
-            )[0]
-            model_preds.append(_model_preds)
-            preds += np.argsort(_model_preds, axis=1).tolist()
-            frames = frames[batch_size:]
-
-        probs = []
-        for i, single_preds in enumerate(preds):
-            single_probs = []
-            for j, pred in enumerate(single_preds):
-                single_probs.append(model_preds[int(i / batch_size)][int(i % batch_size)][pred])
-                preds[i][j] = categories[pred]
-
-            probs.append(single_probs)
-
-        return_preds = {
-            "metadata": {
-                "fps": fps,
-                "video_length": video_length,
-                "video_path": video_path,
-            },
-            "preds": {},
+        metadata = {
+            "fps": demuxer.fps,
+            "video_length": demuxer.frame_count,
+            "video_path": video_path,
         }
+        if compact:
+            return {
+                "metadata": metadata,
+                "frame_indices": np.asarray(result["names"]),
+                "categories": result["categories"],
+                "scores": result["scores"],
+            }
 
-        for i, frame_name in enumerate(frame_names):
-            return_preds["preds"][frame_name] = {}
-            for _ in range(len(preds[i])):
-                return_preds["preds"][frame_name][preds[i][_]] = probs[i][_]
+        return {"metadata": metadata, "preds": result}
 
-        return return_preds
 
-    def classify(
-        self,
-        image_paths=[],
-        batch_size=4,
-        image_size=(256, 256),
-        categories=["unsafe", "safe"],
-    ):
-        """
-        inputs:
-            image_paths: list of image paths or can be a string too (for single image)
-            batch_size: batch_size for running predictions
-            image_size: size to which the image needs to be resized
-            categories: since the model predicts numbers, categories is the list of actual names of categories
-        """
-        if not isinstance(image_paths, list):
-            image_paths = [image_paths]
-
-        loaded_images, loaded_image_paths = load_images(image_paths, image_size, image_names=image_paths)
-
-        if not loaded_image_paths:
-            return {}
+def check_visual_moderation(video_filepath, demuxer=None):
+    classifier = Classifier()
+    result = classifier.classify_video(video_filepath, demuxer=demuxer, compact=True)
+    # No frame decoded, like the early exit and windowed checks there is no ratio to report
+    if not result:
+        return None
 
-        preds = []
-        model_preds = []
-        while len(loaded_images):
-            _model_preds = self.nsfw_model.run(
-                [self.nsfw_model.get_outputs()[0].name],
-                {self.nsfw_model.get_inputs()[0].name: loaded_images[:batch_size]},
-            )[0]
-            model_preds.append(_model_preds)
-            preds += np.argsort(_model_preds, axis=1).tolist()
-            loaded_images = loaded_images[batch_size:]
+    unsafe_scores = result["scores"][:, result["categories"].index("unsafe")]
+    unsafe_ratio = float((unsafe_scores > 0.5).mean())
 
-        probs = []
-        for i, single_preds in enumerate(preds):
-            single_probs = []
-            for j, pred in enumerate(single_preds):
-                single_probs.append(model_preds[int(i / batch_size)][int(i % batch_size)][pred])
-                preds[i][j] = categories[pred]
+    return unsafe_ratio
 
-            probs.append(single_probs)
 
-        images_preds = {}
+def coarse_to_fine_order(n):
+    """
+    Orders range(n) so that every prefix is spread evenly over it: the ends and middle
+    first, then the quarter points, and so on (bit-reversed / van der Corput order).
+    """
+    if n <= 0:
+        return []
+    n_bits = max(int(n - 1).bit_length(), 1)
+    reversed_indices = [int(format(i, f"0{n_bits}b")[::-1], 2) for i in range(1 << n_bits)]
+    return [i for i in reversed_indices if i < n]
 
-        for i, loaded_image_path in enumerate(loaded_image_paths):
-            if not isinstance(loaded_image_path, str):
-                loaded_image_path = i
 
-            images_preds[loaded_image_path] = {}
-            for _ in range(len(preds[i])):
-                images_preds[loaded_image_path][preds[i][_]] = float(probs[i][_])
+def unsafe_ratio_bounds(n_unsafe, n_examined, n_total, z):
+    """
+    Wilson score interval for the unsafe ratio of all n_total frames after examining
+    n_examined of them. Frames are sampled without replacement, so the sample size is
+    inflated by the finite population correction; the bounds are exact once every
+    frame has been examined.
+    """
+    ratio = n_unsafe / n_examined
+    if n_examined >= n_total:
+        return ratio, ratio
 
-        return images_preds
+    n = n_examined * (n_total - 1) / (n_total - n_examined)
+    denominator = 1 + z**2 / n
+    centre = (ratio + z**2 / (2 * n)) / denominator
+    half_width = z * np.sqrt(ratio * (1 - ratio) / n + z**2 / (4 * n**2)) / denominator
+    return max(float(centre - half_width), 0.0), min(float(centre + half_width), 1.0)
 
 
-def check_visual_moderation(video_filepath):
-    classifier = Classifier()
-    result = classifier.classify_video(video_filepath)
+def check_visual_moderation_early_exit(video_filepath, demuxer=None, image_size=None):
+    """
+    Decides whether a video's unsafe ratio is above VISUAL_UNSAFE_RATIO_THRESHOLD (default 0.5)
+    without classifying every frame. The frames on the SKIP_N_FRAMES grid are visited coarse to
+    fine in rounds, VISUAL_EARLY_EXIT_FIRST_ROUND frames (default 8) first and doubling after
+    that, each round one ONNX batch. It stops once the confidence interval of the ratio
+    (VISUAL_EARLY_EXIT_Z, default 2.576 for 99%) is entirely on one side of the threshold,
+    or a frame scores above VISUAL_EARLY_EXIT_HARD_LIMIT (off unless set).
+    Frames aren't deduplicated: the visited frames are far apart until the last rounds.
+
+    outputs:
+        {"unsafe_ratio", "flagged", "decided_by", "frames_examined", "frames_total"}
+        decided_by is "confidence", "hard_limit" or "all_frames"
+    """
+    if demuxer is None:
+        with VideoDemuxer(video_filepath) as demuxer:
+            return check_visual_moderation_early_exit(video_filepath, demuxer, image_size)
+
+    ratio_threshold = float(os.getenv("VISUAL_UNSAFE_RATIO_THRESHOLD", 0.5))
+    z = float(os.getenv("VISUAL_EARLY_EXIT_Z", 2.576))
+    hard_limit = os.getenv("VISUAL_EARLY_EXIT_HARD_LIMIT")
+    hard_limit = float(hard_limit) if hard_limit else None
+    round_size = int(os.getenv("VISUAL_EARLY_EXIT_FIRST_ROUND", 8))
+
+    skip_n_frames = float(os.getenv("SKIP_N_FRAMES", 0.5))
+    if skip_n_frames < 1:
+        skip_n_frames = skip_n_frames * demuxer.fps
+    candidates = np.arange(0, demuxer.frame_count, max(int(skip_n_frames), 1))
+    order = candidates[coarse_to_fine_order(len(candidates))]
+
+    engine = ModerationEngine(
+        decode=lambda targets: ((frame_i + 1, frame) for frame_i, frame in demuxer.frames_at(targets)),
+        image_size=image_size,
+    )
+    n_examined = 0
+    n_unsafe = 0
+    decided_by = "all_frames"
+    position = 0
+    while position < len(order):
+        targets = order[position : position + round_size]
+        position += len(targets)
+        round_size *= 2
+
+        names, scores = engine.scores(targets)
+        if not names:
+            continue
+
+        unsafe_scores = scores[:, engine.categories.index("unsafe")]
+        n_examined += len(names)
+        n_unsafe += int((unsafe_scores > 0.5).sum())
+
+        if hard_limit is not None and unsafe_scores.max() > hard_limit:
+            decided_by = "hard_limit"
+            break
+        lower, upper = unsafe_ratio_bounds(n_unsafe, n_examined, len(order), z)
+        if position < len(order) and (lower > ratio_threshold or upper <= ratio_threshold):
+            decided_by = "confidence"
+            break
+
+    logging.info(f"{n_examined} of {len(order)} frames examined from {video_filepath}, decided by {decided_by}")
+
+    if not n_examined:
+        return {"unsafe_ratio": None, "flagged": None, "decided_by": decided_by, "frames_examined": 0, "frames_total": len(order)}
+
+    unsafe_ratio = n_unsafe / n_examined
+    return {
+        "unsafe_ratio": unsafe_ratio,
+        "flagged": decided_by == "hard_limit" or unsafe_ratio > ratio_threshold,
+        "decided_by": decided_by,
+        "frames_examined": n_examined,
+        "frames_total": len(order),
+    }
+
+
+def window_starts(duration, window_seconds, overlap_seconds):
+    """Start times of the overlapping windows covering duration, matching iter_audio_windows."""
+    hop = window_seconds - overlap_seconds
+    starts = [0.0]
+    while starts[-1] + window_seconds < duration:
+        starts.append(starts[-1] + hop)
+    return starts
+
+
+def check_visual_moderation_windowed(video_filepath, demuxer=None, window_seconds=None, overlap_seconds=None, image_size=None):
+    """
+    Visual moderation for videos of any length. Interesting frames are classified as they are
+    decoded, LONG_MEDIA_FRAME_BATCH (default 32) at a time, and only their unsafe scores are kept,
+    so memory stays flat. Scores are then bucketed into the same overlapping windows as
+    audio_model.audio_moderate_windowed.
 
-    frame_count = len(result["preds"])  # Total number of frames
+    outputs:
+        {"unsafe_ratio": ratio over the whole video, "timeline": [{"start", "end", "video-unsafe", "frames"}]}
+    """
+    window_seconds = window_seconds or float(os.getenv("LONG_MEDIA_WINDOW_SECONDS", 30))
+    overlap_seconds = overlap_seconds or float(os.getenv("LONG_MEDIA_OVERLAP_SECONDS", 5))
+    frame_batch = int(os.getenv("LONG_MEDIA_FRAME_BATCH", 32))
+
+    if demuxer is None:
+        with VideoDemuxer(video_filepath) as demuxer:
+            return check_visual_moderation_windowed(video_filepath, demuxer, window_seconds, overlap_seconds, image_size)
+
+    engine = ModerationEngine(decode=decode_video_frames, dedupe=dedupe_frames(), image_size=image_size)
+    frame_indices = []
+    unsafe_scores = []
+    for names, scores in engine.iter_scores(demuxer, chunk_size=frame_batch):
+        frame_indices.extend(names)
+        unsafe_scores.extend(scores[:, engine.categories.index("unsafe")].tolist())
+
+    if not frame_indices:
+        return {"unsafe_ratio": None, "timeline": []}
+
+    fps = demuxer.fps or 1
+    frame_times = (np.asarray(frame_indices) - 1) / fps
+    unsafe = np.asarray(unsafe_scores) > 0.5
+
+    timeline = []
+    for start in window_starts(demuxer.duration, window_seconds, overlap_seconds):
+        end = min(start + window_seconds, demuxer.duration)
+        in_window = (frame_times >= start) & (frame_times < start + window_seconds)
+        n_frames = int(in_window.sum())
+        timeline.append(
+            {
+                "start": start,
+                "end": end,
+                "video-unsafe": float(unsafe[in_window].mean()) if n_frames else None,
+                "frames": n_frames,
+            }
+        )
 
-    unsafe_count = 0
-    for frame in result["preds"].values():
-        if frame["unsafe"] > 0.5:
-            unsafe_count += 1
-    unsafe_ratio = unsafe_count / frame_count
-    
-    return unsafe_ratio
+    return {"unsafe_ratio": float(unsafe.mean()), "timeline": timeline}
 
 
 if __name__ == "__main__":